@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the echo/pulse expansion on a synthetic one second frame.
+
+Compares the previous implementation (python loop for the echo index and
+successive np.insert for the zero echo padding) with expand_pulses.
+
+    python bench/echopulse_expand.py
+"""
+import numpy as np
+
+from fdwli3ds.echopulse import expand_pulses
+from harness import compare
+
+# about 300k pulses per second, like the test dataset
+NPULSES = 300000
+
+
+def legacy_expand_pulses(pulse_arrays, echo_arrays):
+    vec_echo = pulse_arrays['n_echo']
+    zero_indices = vec_echo.cumsum()[vec_echo == 0].astype('int64')
+    point_arrays = {}
+    for name, values in echo_arrays.items():
+        point_arrays[name] = np.insert(values, zero_indices, 0)
+    point_arrays['echo'] = np.fromiter([
+        idx
+        for ne in vec_echo
+        for idx in range(ne)],
+        dtype='uint8')
+    point_arrays['echo'] = np.insert(
+        point_arrays['echo'], zero_indices, 0).astype('uint8')
+    n_echo_copy = vec_echo.copy()
+    n_echo_copy[n_echo_copy == 0] = 1
+    for name, values in pulse_arrays.items():
+        point_arrays[name] = values.repeat(n_echo_copy)
+    return point_arrays
+
+
+def synthetic_frame(npulses):
+    rand = np.random.RandomState(0)
+    n_echo = rand.choice(
+        [0, 1, 2, 3, 4], size=npulses,
+        p=[0.1, 0.6, 0.2, 0.08, 0.02]).astype('uint8')
+    nechos = int(n_echo.sum())
+    pulse_arrays = {
+        'n_echo': n_echo,
+        'phi': rand.rand(npulses).astype('float32'),
+        'theta': rand.rand(npulses).astype('float32'),
+        'time': 41939 + np.arange(npulses, dtype='float64') / npulses,
+    }
+    echo_arrays = {
+        'amplitude': rand.rand(nechos).astype('float32'),
+        'range': rand.rand(nechos).astype('float32'),
+        'reflectance': rand.rand(nechos).astype('float32'),
+        'deviation': rand.randint(0, 255, nechos).astype('uint8'),
+    }
+    return pulse_arrays, echo_arrays
+
+
+def main():
+    pulse_arrays, echo_arrays = synthetic_frame(NPULSES)
+    npoints = int(np.maximum(pulse_arrays['n_echo'], 1).sum())
+
+    legacy = legacy_expand_pulses(pulse_arrays, echo_arrays)
+    current = expand_pulses(pulse_arrays, echo_arrays)
+    for name in legacy:
+        assert np.array_equal(legacy[name], current[name]), name
+
+    print('{} pulses, {} points per frame'.format(NPULSES, npoints))
+    for label, _, best in compare((
+            ('before', lambda: [legacy_expand_pulses(pulse_arrays, echo_arrays)]),
+            ('after', lambda: [expand_pulses(pulse_arrays, echo_arrays)])), repeat=5):
+        print('{:>6}: {:8.1f} ms/frame {:12.0f} points/s'.format(
+            label, best * 1000, npoints / best))
+
+
+if __name__ == '__main__':
+    main()
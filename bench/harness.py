@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Timing helpers shared by the benchmarks of this directory.
+
+A benchmark compares variants of a computation, each given as a function
+returning a fresh iterable (patches, rows...) which is consumed and timed.
+Benchmarks are run from the root of the repository:
+
+    python bench/<benchmark>.py
+"""
+import time
+
+
+def measure(items, size=None, clock=time.time):
+    """
+    Consume items, returns their count (or the sum of size(item)) and the
+    elapsed time
+    """
+    start = clock()
+    if size is None:
+        count = sum(1 for _ in items)
+    else:
+        count = sum(size(item) for item in items)
+    return count, clock() - start
+
+
+def compare(variants, repeat=1, size=None, clock=time.time):
+    """
+    Yield the (label, count, elapsed) of each (label, function) of variants,
+    keeping the best elapsed time of repeat runs. The call of the function
+    is timed too, it may compute its results eagerly.
+    """
+    for label, func in variants:
+        best = None
+        for _ in range(repeat):
+            start = clock()
+            count, _ = measure(func(), size, clock)
+            elapsed = clock() - start
+            best = elapsed if best is None else min(best, elapsed)
+        yield label, count, best
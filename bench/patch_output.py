@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the patch output modes on one million synthetic points
+with the Sbet point layout (11 doubles).
+
+Compares the previous patch assembly (header concatenated to the packed
+points, then hex encoded) with point_patch followed by format_patch in hex
+and bytea modes. Reports the bytes handed over to PostgreSQL and the CPU
+time per million points.
+
+    python bench/patch_output.py
+"""
+import time
+from struct import pack
+from binascii import hexlify
+
+import numpy as np
+
+from fdwli3ds.pcpatch import point_patch, format_patch
+from harness import compare
+
+NPOINTS = 1000000
+PATCH_SIZE = 400
+POINT_TYPE = np.dtype([(name, '<f8') for name in (
+    'm_time', 'y', 'x', 'z', 'xvelocity', 'yvelocity', 'zvelocity',
+    'roll', 'pitch', 'heading', 'wander')])
+
+
+def legacy_patches(points):
+    for start in range(0, len(points), PATCH_SIZE):
+        chunk = points[start:start + PATCH_SIZE]
+        header = pack('<b3I', 1, 1, 0, len(chunk))
+        yield hexlify(header + chunk.tostring())
+
+
+def output_patches(points, output):
+    for start in range(0, len(points), PATCH_SIZE):
+        chunk = points[start:start + PATCH_SIZE]
+        yield format_patch(point_patch(1, len(chunk), [chunk]), output)
+
+
+def main():
+    rand = np.random.RandomState(0)
+    points = np.frombuffer(
+        rand.rand(NPOINTS * len(POINT_TYPE)).tostring(), dtype=POINT_TYPE)
+
+    assert all(
+        old == new for old, new in
+        zip(legacy_patches(points), output_patches(points, 'hex')))
+
+    print('{} points, {} points per patch'.format(NPOINTS, PATCH_SIZE))
+    scale = 1e6 / NPOINTS
+    for label, nbytes, cpu in compare((
+            ('legacy', lambda: legacy_patches(points)),
+            ('hex', lambda: output_patches(points, 'hex')),
+            ('bytea', lambda: output_patches(points, 'bytea'))),
+            repeat=3, size=len, clock=time.clock):
+        print('{:>6}: {:7.1f} MB {:8.1f} ms CPU per million points'.format(
+            label, nbytes * scale / 1e6, cpu * scale * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the filters of PointCloud2 points, on synthetic Velodyne
+HDL-64 scans (about 130k points of 32 bytes each, 1% of nan points,
+ranges up to 120 meters).
+
+Reports the time per scan and the points kept by the nan, range and voxel
+grid filters, then by the patches of a scan built with and without
+filters (the patches handed over to PostgreSQL shrink with the points).
+
+    python bench/rosbag_filters.py [number of scans]
+"""
+import sys
+
+import numpy as np
+
+from fdwli3ds.pcpatch import point_patch, format_patch
+from fdwli3ds.rosbag_ import filter_points
+from harness import measure
+
+POINTS_PER_SCAN = 130000
+POINT_STEP = 32
+POINT_VIEW = np.dtype({
+    'names': ['x', 'y', 'z'], 'formats': ['<f4'] * 3,
+    'offsets': [0, 4, 8], 'itemsize': POINT_STEP})
+POINT_RECORD = np.dtype((np.void, POINT_STEP))
+
+FILTERS = (
+    ('nan', {'drop_nan': True}),
+    ('range', {'range_min': 2, 'range_max': 80}),
+    ('voxel 0.1', {'voxel_size': 0.1}),
+    ('voxel 0.5', {'voxel_size': 0.5}),
+    ('all', {'range_min': 2, 'range_max': 80, 'voxel_size': 0.1}),
+)
+
+
+def synthetic_scans(nscans):
+    rand = np.random.RandomState(0)
+    scans = []
+    for _ in range(nscans):
+        data = rand.randint(0, 255, POINTS_PER_SCAN * POINT_STEP).astype('u1')
+        points = data.view(POINT_VIEW)
+        azimuth = rand.rand(POINTS_PER_SCAN) * 2 * np.pi
+        distance = 120 * rand.rand(POINTS_PER_SCAN) ** 2
+        points['x'] = distance * np.cos(azimuth)
+        points['y'] = distance * np.sin(azimuth)
+        points['z'] = rand.rand(POINTS_PER_SCAN) * 3 - 2
+        points['x'][rand.rand(POINTS_PER_SCAN) < 0.01] = np.nan
+        scans.append(data.tostring())
+    return scans
+
+
+def scan_patch(data, options):
+    records = np.frombuffer(data, dtype=POINT_RECORD)
+    if options:
+        records = records[filter_points(records.view(POINT_VIEW), **options)]
+    return format_patch(point_patch(1, len(records), [records]))
+
+
+def main():
+    nscans = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    scans = synthetic_scans(nscans)
+    print('{} scans of {} points'.format(nscans, POINTS_PER_SCAN))
+    for label, options in (('none', {}),) + FILTERS:
+        kept, filtered = nscans * POINTS_PER_SCAN, 0
+        if options:
+            kept, filtered = measure((
+                filter_points(np.frombuffer(data, dtype=POINT_VIEW), **options)
+                for data in scans), size=len)
+        nbytes, patched = measure((scan_patch(data, options) for data in scans), size=len)
+        print('{:>9}: {:6.1f}% points kept {:6.1f} ms filter {:6.1f} ms patch '
+              '{:7.1f} MB per scan'.format(
+                  label, 100. * kept / (nscans * POINTS_PER_SCAN),
+                  1000 * filtered / nscans, 1000 * patched / nscans,
+                  nbytes / 1e6 / nscans))
+
+
+if __name__ == '__main__':
+    main()
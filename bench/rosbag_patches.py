@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the patch assembly of PointCloud2 messages, on synthetic
+Velodyne HDL-64 scans (about 130k points of 32 bytes each).
+
+Compares the previous assembly (string concatenation of the messages,
+then reslicing the remaining data after each patch) with PatchAssembler,
+for patches of 400 points cut every 400 points, or every 399 points
+(replicating the last point of each patch).
+
+When the rosbag and sensor_msgs packages are available, a synthetic bag
+is also written (with the given chunk compression: none, bz2 or lz4) and
+read with the Rosbag wrapper, from the serialized messages (points only),
+from the serialized messages read ahead in a thread (prefetch option) and
+from the messages deserialized by genpy (requesting the data column too).
+
+    python bench/rosbag_patches.py [number of scans] [compression]
+"""
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from fdwli3ds.pcpatch import point_patch, format_patch
+from fdwli3ds.rosbag_ import PatchAssembler
+from harness import compare, measure
+
+POINTS_PER_SCAN = 130000
+POINT_STEP = 32
+PATCH_COUNT = 400
+
+
+def synthetic_scans(nscans):
+    rand = np.random.RandomState(0)
+    return [
+        rand.randint(0, 255, POINTS_PER_SCAN * POINT_STEP).astype('u1').tostring()
+        for _ in range(nscans)
+    ]
+
+
+def legacy_patches(scans, size, step):
+    patch_data = ''
+    for data in scans:
+        patch_data += data
+        while len(patch_data) >= size:
+            patch = patch_data[0:size]
+            yield format_patch(point_patch(1, size // POINT_STEP, [patch]))
+            patch_data = patch_data[step:]
+
+
+def assembler_patches(scans, size, step):
+    assembler = PatchAssembler()
+    for data in scans:
+        assembler.append(data)
+        for patch in assembler.patches(size, step):
+            yield format_patch(point_patch(1, size // POINT_STEP, [patch]))
+
+
+def bench_rosbag(nscans, compression):
+    try:
+        import rosbag
+        from rospy.rostime import Time
+        from sensor_msgs.msg import PointCloud2, PointField
+    except ImportError:
+        print('rosbag is not available, skipping the synthetic bag')
+        return
+    from fdwli3ds import Rosbag
+
+    fields = [
+        PointField(name=name, offset=offset, datatype=PointField.FLOAT32, count=1)
+        for name, offset in (('x', 0), ('y', 4), ('z', 8), ('intensity', 16))
+    ] + [PointField(name='ring', offset=20, datatype=PointField.UINT16, count=1)]
+    fd, filename = tempfile.mkstemp(suffix='.bag')
+    os.close(fd)
+    try:
+        with rosbag.Bag(filename, 'w', compression=compression) as bag:
+            for idx, data in enumerate(synthetic_scans(nscans)):
+                stamp = Time(1492648601 + idx // 10, (idx % 10) * 100000000)
+                msg = PointCloud2(
+                    height=1, width=POINTS_PER_SCAN, fields=fields,
+                    is_bigendian=False, point_step=POINT_STEP,
+                    row_step=POINT_STEP * POINTS_PER_SCAN, data=data,
+                    is_dense=True)
+                msg.header.stamp = stamp
+                bag.write('/velodyne_points', msg, stamp)
+        for label, columns, prefetch in (('raw', ['points'], '0'),
+                                         ('prefetch', ['points'], '16'),
+                                         ('genpy', ['points', 'data'], '0')):
+            reader = Rosbag({
+                'rosbag': filename,
+                'topic': '/velodyne_points',
+                'patch_count_pointcloud': str(PATCH_COUNT),
+                'prefetch': prefetch,
+            }, columns)
+            count, elapsed = measure(reader.execute([], columns))
+            print('rosbag {:>8}: {} patches {:8.2f} s {:12.0f} points/s'.format(
+                label, count, elapsed, nscans * POINTS_PER_SCAN / elapsed))
+    finally:
+        os.remove(filename)
+
+
+def main():
+    nscans = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    compression = sys.argv[2] if len(sys.argv) > 2 else 'none'
+    scans = synthetic_scans(nscans)
+    size = PATCH_COUNT * POINT_STEP
+    print('{} scans of {} points, {} points per patch'.format(
+        nscans, POINTS_PER_SCAN, PATCH_COUNT))
+    for step_label, step in (('step', size), ('replicating', size - POINT_STEP)):
+        for label, count, elapsed in compare((
+                ('legacy', lambda: legacy_patches(scans, size, step)),
+                ('assembler', lambda: assembler_patches(scans, size, step)))):
+            print('{:>11} {:>9}: {} patches {:8.2f} s {:12.0f} points/s'.format(
+                step_label, label, count, elapsed,
+                nscans * POINTS_PER_SCAN / elapsed))
+    bench_rosbag(nscans, compression)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the row extraction of non PointCloud2 messages, on
+synthetic Imu-like messages (header, quaternion, two vectors and three
+covariance arrays) read into columns and into packed points.
+
+Compares the previous extraction (dotted column names walked and the
+converter chosen for each value of each message, struct format parsed
+for each point) with the plan compiled once per scan (attrgetter chains,
+converters chosen from the first message, precompiled struct).
+
+    python bench/rosbag_rows.py [number of messages]
+"""
+import sys
+from struct import pack, Struct
+
+from fdwli3ds.rosbag_ import compile_getter, compile_converter
+from harness import compare
+
+COLUMNS = (
+    'header.seq', 'header.stamp', 'header.frame_id', 'orientation',
+    'orientation_covariance', 'angular_velocity',
+    'angular_velocity_covariance', 'linear_acceleration',
+    'linear_acceleration_covariance',
+)
+PATCH_COLUMNS = ('header.stamp', 'angular_velocity', 'linear_acceleration')
+FMT = '=q3d3d'
+
+
+class Msg(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Stamp(object):
+    def __init__(self, nsec):
+        self.nsec = nsec
+
+    def to_nsec(self):
+        return self.nsec
+
+
+def synthetic_messages(count):
+    return [
+        Msg(header=Msg(seq=idx, stamp=Stamp(idx * 5000000), frame_id='imu'),
+            orientation=Msg(x=0., y=0., z=0., w=1.),
+            orientation_covariance=[0.] * 9,
+            angular_velocity=Msg(x=idx, y=0., z=0.),
+            angular_velocity_covariance=[0.] * 9,
+            linear_acceleration=Msg(x=0., y=0., z=9.81),
+            linear_acceleration_covariance=[0.] * 9)
+        for idx in range(count)
+    ]
+
+
+def point_data(row, point_pack):
+    val = list()
+    for column in PATCH_COLUMNS:
+        if isinstance(row[column], tuple):
+            val.extend(row[column])
+        else:
+            val.append(row[column])
+    return point_pack(*val)
+
+
+def legacy_rows(msgs):
+    for msg in msgs:
+        res = {}
+        for column in COLUMNS:
+            attr = msg
+            for col in column.split('.'):
+                if isinstance(attr, list):
+                    attr = tuple(getattr(a, col) for a in attr)
+                else:
+                    attr = getattr(attr, col)
+            if hasattr(attr, "to_nsec"):
+                attr = attr.to_nsec()
+            elif hasattr(attr, "x"):
+                if hasattr(attr, "w"):
+                    attr = (attr.x, attr.y, attr.z, attr.w)
+                else:
+                    attr = (attr.x, attr.y, attr.z)
+            res[column] = attr
+        yield res, point_data(res, lambda *val: pack(FMT, *val))
+
+
+def compiled_rows(msgs):
+    accessors = None
+    for msg in msgs:
+        if accessors is None:
+            accessors = []
+            for column in COLUMNS:
+                getter, attr = compile_getter(msg, column)
+                accessors.append((column, getter, compile_converter(attr, None)))
+            point_pack = Struct(FMT).pack
+        res = {}
+        for column, getter, convert in accessors:
+            attr = getter(msg)
+            res[column] = convert(attr) if convert else attr
+        yield res, point_data(res, point_pack)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    msgs = synthetic_messages(count)
+    assert list(legacy_rows(msgs[:100])) == list(compiled_rows(msgs[:100]))
+    print('{} messages, {} columns'.format(count, len(COLUMNS)))
+    for label, _, elapsed in compare((
+            ('legacy', lambda: legacy_rows(msgs)),
+            ('compiled', lambda: compiled_rows(msgs))), repeat=3):
+        print('{:>8}: {:8.2f} s {:6.2f} us per message'.format(
+            label, elapsed, elapsed * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of sbet reading on a synthetic sbet file (2 GB by default).
+
+Compares the previous implementation (copy-on-write memory map converted
+in place and cast for each patch, overlap record concatenated to each
+patch) with Sbet.read_sbet, which converts chunks of records at once and
+cuts patches as views of the converted chunk.
+
+    python bench/sbet_convert.py [size in GB] [patch size]
+"""
+import os
+import sys
+import math
+import tempfile
+from struct import pack
+from binascii import hexlify
+
+import numpy as np
+
+from fdwli3ds import Sbet
+from harness import compare
+
+# records written at once when generating the file
+GENERATE_CHUNK = 1 << 20
+
+
+def generate(filename, nrecords, ndims):
+    """
+    Write a synthetic trajectory at 200 Hz
+    """
+    rand = np.random.RandomState(0)
+    with open(filename, 'wb') as sbet:
+        for start in range(0, nrecords, GENERATE_CHUNK):
+            count = min(GENERATE_CHUNK, nrecords - start)
+            records = rand.rand(count, ndims)
+            records[:, 0] = 300000 + np.arange(start, start + count) / 200.
+            sbet.write(records.tostring())
+
+
+def legacy_read_sbet(reader, sbetfile):
+    scales = {
+        dim.name.lower(): float(dim.scale) for dim in reader.dimensions
+        if dim.name.lower() in ('x', 'y', 'z')
+    }
+    rad2deg_scaled_x = 180 / math.pi / scales['x']
+    rad2deg_scaled_y = 180 / math.pi / scales['y']
+    scale_z = scales['z']
+    sbet_patch_type = reader.patch_type()
+
+    sbet = np.memmap(sbetfile, dtype=reader.source_type(), mode='c')
+    sbet_size = len(sbet)
+    slices = [
+        slice(a, b)
+        for a, b in zip(
+            range(0, sbet_size, reader.patch_size),
+            range(reader.patch_size, sbet_size, reader.patch_size)
+        )
+    ]
+    if slices[-1].stop != sbet_size:
+        slices.append(slice(slices[-1].stop, sbet_size))
+
+    last_one = None
+    for idx, sli in enumerate(slices):
+        subarray = sbet[sli]
+        subarray['x'] = rad2deg_scaled_x * subarray['x']
+        subarray['y'] = rad2deg_scaled_y * subarray['y']
+        subarray['z'] = subarray['z'] / scale_z
+        subarray['m_time'] += reader.time_offset
+        subarray = subarray.astype(sbet_patch_type)
+        if idx > 0 and reader.overlap:
+            header = pack('<b3I', 1, reader.pcid, 0, sli.stop - sli.start + 1)
+            data = hexlify(header + last_one.tostring() + subarray.tostring())
+            last_one = subarray[-1]
+            yield {'points': data}
+        else:
+            header = pack('<b3I', 1, reader.pcid, 0, sli.stop - sli.start)
+            last_one = subarray[-1]
+            yield {'points': hexlify(header + subarray.tostring())}
+
+
+def main():
+    size = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    patch_size = sys.argv[2] if len(sys.argv) > 2 else '100'
+
+    options = {'pcid': '1', 'patch_size': patch_size, 'overlap': 'true'}
+    reader = Sbet(options, None)
+    bytea_reader = Sbet(dict(options, output='bytea'), None)
+    ndims = len(reader.dimensions)
+    nrecords = int(size * 1e9 / (8 * ndims))
+
+    fd, filename = tempfile.mkstemp(suffix='.sbet')
+    os.close(fd)
+    try:
+        generate(filename, nrecords, ndims)
+        print('{} records ({:.1f} GB), {} points per patch'.format(
+            nrecords, os.path.getsize(filename) / 1e9, patch_size))
+        for label, count, elapsed in compare((
+                ('legacy', lambda: legacy_read_sbet(reader, filename)),
+                ('hex', lambda: reader.read_sbet(filename)),
+                ('bytea', lambda: bytea_reader.read_sbet(filename)))):
+            print('{:>6}: {} patches {:8.2f} s {:12.0f} points/s'.format(
+                label, count, elapsed, nrecords / elapsed))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,17 @@
 # -*- coding: utf-8 -*-
 import os
 import re
-import glob
-from struct import pack
-from collections import defaultdict, namedtuple
-from binascii import hexlify
+import json
+import math
+from collections import namedtuple
 from StringIO import StringIO
 
 import numpy as np
-from multicorn.utils import log_to_postgres
+from multicorn.utils import log_to_postgres, ERROR, WARNING
 
 from .foreignpc import ForeignPcBase
+from .pcpatch import dimensional_patch, format_patch, patch_width
+from .util import get_bounds, overlaps, bounded_fraction, ordered_imap, save_json
 
 # pattern for the echo/pulse schema directory
 subtree_pattern = re.compile(r'^(echo|pulse)-([\w\d]+)-(.*)$')
@@ -57,6 +58,353 @@ def get_size(strtype):
     return int(re.search(r'\d+', strtype).group()) / 8
 
 
+def open_array(filename, dtype, count):
+    """
+    Memory-map at most count values of type dtype stored in a binary file
+    """
+    if not count or not os.path.getsize(filename):
+        # empty files can not be mapped
+        return np.empty(0, dtype=dtype)
+    return np.memmap(str(filename), dtype=dtype, mode='r')[:count]
+
+
+def linear_time_slice(t0, delta, count, bounds):
+    """
+    Returns the slice of pulse indices whose linear time t0 + idx * delta
+    lies inside bounds (as returned by get_bounds).
+    The estimated limits are adjusted on the exact time values
+    to stay consistent with the times written in patches.
+    """
+    def time(idx):
+        return t0 + idx * delta
+
+    def after_lower(idx):
+        lower = bounds[0]
+        return lower is None or time(idx) > lower[0] or \
+            (lower[1] and time(idx) == lower[0])
+
+    def before_upper(idx):
+        upper = bounds[1]
+        return upper is None or time(idx) < upper[0] or \
+            (upper[1] and time(idx) == upper[0])
+
+    def estimate(value):
+        return min(max(int(math.floor((value - t0) / delta)), 0), count)
+
+    start, stop = 0, count
+    if bounds[0] is not None:
+        start = estimate(bounds[0][0])
+        while start > 0 and after_lower(start - 1):
+            start -= 1
+        while start < count and not after_lower(start):
+            start += 1
+    if bounds[1] is not None:
+        stop = estimate(bounds[1][0])
+        while stop > 0 and not before_upper(stop - 1):
+            stop -= 1
+        while stop < count and before_upper(stop):
+            stop += 1
+    return slice(start, max(start, stop))
+
+
+def expand_pulses(pulse_arrays, echo_arrays, echo_index=True):
+    """
+    Expand pulse and echo values of consecutive whole pulses to points.
+    Pulse values are repeated for each echo and a pulse without echo produces
+    a single point with echo values set to zero.
+    The echo index is added as a new dimension if echo_index is true.
+
+    Each output is allocated once and filled by a single gather (pulse
+    dimensions) or scatter (echo dimensions) driven by n_echo.
+    """
+    vec_echo = pulse_arrays['n_echo']
+    # a pulse without echo still produces one point
+    counts = np.maximum(vec_echo, 1).astype('int64')
+    npoints = int(counts.sum())
+    point_first = counts.cumsum() - counts
+
+    # pulse index of each point
+    pulse_index = np.repeat(np.arange(len(vec_echo)), counts)
+    # points carrying an echo, in the same order as the echo arrays
+    has_echo = np.repeat(vec_echo > 0, counts)
+
+    point_arrays = {}
+    for name, values in pulse_arrays.items():
+        point_arrays[name] = np.empty(npoints, dtype=values.dtype)
+        np.take(values, pulse_index, out=point_arrays[name])
+
+    for name, values in echo_arrays.items():
+        point_arrays[name] = np.zeros(npoints, dtype=values.dtype)
+        point_arrays[name][has_echo] = values
+
+    if echo_index:
+        # add the echo index as a new dimension
+        point_arrays['echo'] = (
+            np.arange(npoints) - point_first[pulse_index]).astype('uint8')
+
+    return point_arrays
+
+
+class EptIndex(object):
+    """
+    Index of the frames of an echo/pulse directory.
+
+    For each frame, it records the file names (one per dimension directory),
+    the linear time parameters t0 and delta, and the number of pulses, echos
+    and points. The index is cached in a json file and is invalidated by the
+    modification times of the dimension directories. Entries of frames
+    already indexed are reused when new frames are added.
+    """
+    version = 1
+
+    def __init__(self, basedir, subdirs, filename):
+        self.basedir = basedir
+        self.subdirs = sorted(subdirs)
+        self.filename = filename
+        self.frames = None
+        # modification times of the subdirs when frames were loaded
+        self.frames_mtimes = None
+
+    def mtimes(self):
+        return [
+            os.path.getmtime(os.path.join(self.basedir, subdir))
+            for subdir in self.subdirs
+        ]
+
+    def load(self):
+        """
+        Read the cached index, rebuilding it if outdated.
+        Returns the list of frames.
+        """
+        mtimes = self.mtimes()
+        # frames already loaded are reused until the subdirs change
+        if self.frames is not None and self.frames_mtimes == mtimes:
+            return self.frames
+        self.frames_mtimes = mtimes
+        cached = {}
+        try:
+            with open(self.filename) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            pass
+        if cached.get('version') != self.version or \
+           cached.get('subdirs') != self.subdirs:
+            cached = {}
+        if cached.get('mtimes') == mtimes:
+            self.frames = cached['frames']
+            return self.frames
+
+        self.frames = self.build(cached.get('frames', []))
+        self.save({
+            'version': self.version,
+            'subdirs': self.subdirs,
+            'mtimes': mtimes,
+            'frames': self.frames,
+        })
+        return self.frames
+
+    def save(self, content):
+        try:
+            save_json(self.filename, content)
+        except (IOError, OSError) as e:
+            log_to_postgres(
+                'echo/pulse index could not be saved: {}'.format(e), WARNING,
+                hint='use the index option to choose a writable location')
+
+    def build(self, previous_frames):
+        """
+        List dimension directories and index new frames
+        """
+        filelists = []
+        for subdir in self.subdirs:
+            filelist = [
+                name for name in os.listdir(os.path.join(self.basedir, subdir))
+                if not name.startswith('.')
+            ]
+            # ordered by name (which is in fact time)
+            filelist.sort()
+            filelists.append(filelist)
+
+        # check consistency, sub directories must have the same number of files
+        source_files_count = set(len(filelist) for filelist in filelists)
+        if len(source_files_count) > 1:
+            raise Exception('Consistency failed, bad number of files in '
+                            'source directories {}'.format(str(source_files_count)))
+
+        previous = dict(
+            (tuple(frame['files']), frame) for frame in previous_frames)
+        frames = []
+        for files in zip(*filelists):
+            frame = previous.get(files)
+            if frame is None:
+                frame = self.index_frame(files)
+            frames.append(frame)
+        return frames
+
+    def index_frame(self, files):
+        frame = {'files': list(files)}
+        for subdir, filename in zip(self.subdirs, files):
+            path = os.path.join(self.basedir, subdir, filename)
+            _, datatype, name = subtree_pattern.match(subdir).groups()
+            if datatype == 'linear':
+                with open(path, 'r') as tfile:
+                    nentries, _, t0, _, delta, _ = tfile.readline().split()
+                frame['pulses'] = int(nentries)
+                frame['t0'] = float(t0)
+                frame['delta'] = float(delta)
+            elif name == 'n_echo':
+                n_echo_file = (path, datatype)
+        n_echo = open_array(n_echo_file[0], n_echo_file[1], frame['pulses'])
+        frame['echos'] = int(n_echo.sum())
+        frame['points'] = int(np.maximum(n_echo, 1).sum())
+        return frame
+
+
+class FrameDecoder(object):
+    """
+    Decode echo/pulse frames to patches.
+    Only holds picklable settings, so that frames can be decoded
+    in a pool of processes.
+
+    Patch windows are aligned on the full scan layout: frame points are cut
+    every patch_size points, and time bounds only truncate the first and last
+    windows. The patch number of a window is thus stable across queries.
+    """
+
+    def __init__(self, pcid, patch_size, time_offset, raw_dimensions,
+                 bounds=(None, None), patch_bounds=(None, None), columns=None,
+                 compression='none', output='hex'):
+        self.pcid = pcid
+        self.patch_size = patch_size
+        self.time_offset = time_offset
+        self.raw_dimensions = raw_dimensions
+        self.bounds = bounds
+        self.patch_bounds = patch_bounds
+        self.columns = set(columns or ())
+        self.compression = compression
+        self.output = output
+
+    def __call__(self, frame):
+        return list(self.patches(frame))
+
+    def patches(self, frame):
+        """
+        Using dimensional compression since datasource is already arranged
+        by dimension (see pcpatch.dimensional_patch), each dimension is
+        compressed according to the compression option.
+        """
+        # read frame, one patch window at a time
+        for window_idx, time, att_array in self.read_ept(frame):
+            patch = dimensional_patch(
+                self.pcid, [values for _, values in att_array],
+                self.compression)
+            row = {'points': format_patch(patch, self.output)}
+            if 'time' in self.columns:
+                row['time'] = time
+            if 'patch_id' in self.columns:
+                row['patch_id'] = frame['first_patch'] + window_idx
+            yield row
+
+    def read_ept(self, frame):
+        """
+        Stream a frame as patch windows of at most patch_size points.
+
+        Dimension files are memory-mapped and only the values needed by the
+        current window are materialized. Pulse and echo offsets of each point
+        are given by the cumulative sum of n_echo (a pulse without echo still
+        produces one point).
+        Yields the window index in the frame, the time of its first point
+        (if the time column is requested) and a list of
+        (dimension name, array) ordered like the xml schema.
+        """
+        pulses = dict(frame['pulse'])
+        del pulses[('linear', 'time')]
+        info = frame['info']
+        nentries = info['pulses']
+        t0 = info['t0'] + self.time_offset
+        delta = info['delta']
+
+        # keep the pulses inside the time bounds
+        pulse_range = linear_time_slice(t0, delta, nentries, self.bounds)
+        start, stop = pulse_range.start, pulse_range.stop
+        if start == stop:
+            return
+
+        # n_echo is always read, other dimensions only if projected
+        necho_key = [key for key in pulses if key[1] == 'n_echo'][0]
+        n_echo_map = open_array(pulses.pop(necho_key), necho_key[0], nentries)
+        dims = set(self.raw_dimensions)
+        n_echo = n_echo_map[pulse_range]
+        # index of the first echo of each pulse and of the first point
+        # following each pulse
+        echo_first = int(n_echo_map[:start].sum()) + \
+            n_echo.cumsum(dtype='int64') - n_echo
+        point_end = np.maximum(n_echo, 1).cumsum(dtype='int64')
+        npoints = int(point_end[-1])
+        # index of the first selected point in the frame
+        point_start = int(np.maximum(n_echo_map[:start], 1).sum())
+
+        pulse_maps = [
+            (name, open_array(filename, datatype, nentries))
+            for (datatype, name), filename in pulses.items()
+            if name in dims
+        ]
+        nechos = int(echo_first[-1] + n_echo[-1])
+        echo_maps = [
+            (name, open_array(filename, datatype, nechos))
+            for (datatype, name), filename in frame['echo'].items()
+            if name in dims
+        ]
+        with_time = 'time' in dims or 'time' in self.columns
+
+        windows = range(
+            point_start // self.patch_size,
+            (point_start + npoints - 1) // self.patch_size + 1)
+        for window_idx in windows:
+            if not overlaps(frame['first_patch'] + window_idx,
+                            frame['first_patch'] + window_idx,
+                            self.patch_bounds):
+                continue
+            # points of this window, relative to pulse_range
+            first_point = max(window_idx * self.patch_size - point_start, 0)
+            last_point = min((window_idx + 1) * self.patch_size - point_start,
+                             npoints)
+            # pulses (relative to pulse_range) covering this window
+            first = int(np.searchsorted(point_end, first_point, side='right'))
+            last = int(np.searchsorted(point_end, last_point - 1, side='right')) + 1
+            window = slice(first, last)
+            echo_window = slice(
+                int(echo_first[first]),
+                int(echo_first[last - 1] + n_echo[last - 1]))
+
+            pulse_arrays = {'n_echo': n_echo[window]}
+            for name, values in pulse_maps:
+                pulse_arrays[name] = values[start + first:start + last]
+            if with_time:
+                pulse_arrays['time'] = (
+                    np.ones(last - first, dtype='float64') * t0 +
+                    np.arange(start + first, start + last, dtype='float64') * delta
+                )
+            echo_arrays = {
+                name: values[echo_window] for name, values in echo_maps
+            }
+
+            point_arrays = expand_pulses(
+                pulse_arrays, echo_arrays, 'echo' in dims)
+            # cut the expanded pulses to the window
+            offset = int(point_end[first] - max(n_echo[first], 1))
+            window_points = slice(first_point - offset, last_point - offset)
+            time = None
+            if 'time' in self.columns:
+                time = float(point_arrays['time'][window_points][0])
+            yield window_idx, time, sorted(
+                ((name, values[window_points])
+                 for name, values in point_arrays.items()
+                 if name in dims),
+                key=lambda x: self.raw_dimensions.index(x[0])
+            )
+
+
 class EchoPulse(ForeignPcBase):
     """
     Foreign class for the Echo/Pulse/Table format
@@ -69,7 +417,7 @@ class EchoPulse(ForeignPcBase):
         """
         super(EchoPulse, self).__init__(options, columns)
         # Resolve data files found in directory
-        self.basedir = options['directory']
+        self.basedir = os.path.realpath(options['directory'])
         sources = (source for source in os.listdir(self.basedir)
                    if subtree_pattern.match(source))
         self.source_dirs = [
@@ -77,6 +425,12 @@ class EchoPulse(ForeignPcBase):
             for source in sources
             if os.path.isdir(os.path.join(self.basedir, source))
         ]
+        # frames are indexed in a cache file, next to the data by default
+        self.index = EptIndex(
+            self.basedir,
+            [os.path.basename(sdir) for sdir in self.source_dirs],
+            options.get('index',
+                        os.path.join(self.basedir, '.echopulse_index.json')))
         # default mapping for coordinates
         self.new_dimnames = {
             'range': 'x',
@@ -91,9 +445,24 @@ class EchoPulse(ForeignPcBase):
         for var in varmapping:
             self.new_dimnames.update({var.strip('map_'): options[var]})
 
+        # optional subset of dimensions (raw or mapped names) to put in
+        # patches, other dimension files are never read
+        self.projection = None
+        if 'dimensions' in options:
+            self.projection = set(
+                dim.strip() for dim in options['dimensions'].split(',')
+                if dim.strip()) or None
+
         # get pointcloud structure from the directory tree
         self.ordered_dims = self.scan_structure()
 
+        # number of frames decoded in parallel (0: in the backend process),
+        # with at most prefetch decoded frames waiting to be returned
+        self.workers = int(options.get('workers', 0))
+        self.prefetch = int(options.get('prefetch', 2 * self.workers))
+        # use a pool of 'thread' (default) or 'process'
+        self.worker_type = options.get('worker_type', 'thread')
+
         log_to_postgres('{} echo/pulse directories linked'
                         .format(len(self.source_dirs)))
 
@@ -115,6 +484,7 @@ class EchoPulse(ForeignPcBase):
         pointcloud schema.
         One directory corresponds to one dimension.
         Dimensions are always ordered by alphabetical order for idempotence
+        and restricted to the dimensions option if given.
         Returns a tuple like that:
             [
                 (1, 32, 'phi', 'float32'),
@@ -123,12 +493,8 @@ class EchoPulse(ForeignPcBase):
             ]
         """
         dimensions = []
-        for subdir in os.listdir(self.basedir):
-            if not subdir.startswith('echo') and \
-               not subdir.startswith('pulse'):
-                # dimension directory should start with the signal type
-                continue
-            _, dtype, name = subdir.split('-')
+        for subdir in self.index.subdirs:
+            _, dtype, name = subtree_pattern.match(subdir).groups()
             dimensions.append((
                 get_size(dtype),
                 name,
@@ -136,6 +502,23 @@ class EchoPulse(ForeignPcBase):
 
         # add the echo index (computed in the code above)
         dimensions.append(('1', 'echo', 'int8'))
+
+        if self.projection is not None:
+            known = set()
+            for _, name, _ in dimensions:
+                known.update((name, self.new_dimnames.get(name, name)))
+            unknown = self.projection - known
+            if unknown:
+                log_to_postgres(
+                    'unknown dimensions: {}'.format(', '.join(sorted(unknown))),
+                    ERROR, hint='available dimensions: {}'.format(
+                        ', '.join(sorted(known))))
+            dimensions = [
+                dim for dim in dimensions
+                if dim[1] in self.projection or
+                self.new_dimnames.get(dim[1], dim[1]) in self.projection
+            ]
+
         sorted_dims = sorted(dimensions, key=lambda x: x[1])
         return [
             (idx, dim[0], dim[1], dim[2])
@@ -147,9 +530,18 @@ class EchoPulse(ForeignPcBase):
         Called each time a request is made on the foreign table.
         Yields each row as a mapping of column: value
 
-        All directories corresponding to an attribute are scanned first, then
-        all files are ordered by time (one file defines one second of acquisition).
-        A dataframe is composed of a data file for each attribute.
+        Quals on the time column are pushed down: frames outside the requested
+        interval are skipped using the frame index and the remaining frames
+        are trimmed to the matching pulse range.
+        When requested, the time column holds the time of the first point of
+        each patch.
+        Quals on the patch_id column (the patch number in a full scan) are
+        pushed down the same way, without reading the previous frames.
+
+        Frames come from the directory index (one file in each attribute
+        directory defines one second of acquisition).
+        A dataframe is composed of a data file for each attribute and of its
+        index entry.
 
         Here is an example of the dataframe structure:
         [
@@ -158,12 +550,16 @@ class EchoPulse(ForeignPcBase):
                     {('linear', 'time'): '1.txt', ('float32', 'phi'): '1.bin', },
                 'echo':
                     {('float32', 'amplitude'): '1.txt', ('float32', 'range'): '1.bin', },
+                'info': {'files': [...], 't0': 1.0000032, 'delta': 3.4e-06, ...},
+                'first_patch': 0,
             },
             {
                 'pulse':
                     {('linear', 'time'): '2.txt', ('float32', 'phi'): '2.bin', },
                 'echo':
                     {('float32', 'amplitude'): '2.txt', ('float32', 'range'): '2.bin', },
+                'info': {'files': [...], 't0': 2.0000032, 'delta': 3.4e-06, ...},
+                'first_patch': 735,
             },
         ]
         """  # NOQA
@@ -177,152 +573,97 @@ class EchoPulse(ForeignPcBase):
                 '8 subdirectories for echo pulse data')
             return
 
-        source_files_count = set()
-        directories = []
-        self.raw_dimensions = [name for s, _, name, _ in self.ordered_dims]
-
-        for sdir in self.source_dirs:
-            filelist = [sfi for sfi in glob.glob(os.path.join(sdir, '*'))]
-            # ordered by name (which is in fact time)
-            filelist.sort()
-            source_files_count.add(len(filelist))
-            # extracting informations on data types and signal types
-            basename = os.path.basename(sdir)
-            signal, datatype, name = subtree_pattern.match(basename).groups()
-
-            # contruct a tuple to store all informations needed to read
-            # the data
-            directories.append((basename, signal, datatype, name, filelist))
-
-        # sort on signal and datatype
-        directories.sort(
-            key=lambda x: (x[1], x[2] == 'linear', x[3] == 'n_echo'),
-            reverse=True
-        )
-
-        # check consistency, sub directories must have the same number of files
-        if len(source_files_count) != 1:
-            raise Exception('Consistency failed, bad number of files in '
-                            'source directories {}'.format(str(source_files_count)))
-
+        bounds = get_bounds(quals, 'time')
+        patch_bounds = get_bounds(quals, 'patch_id')
         framelist = []
-
-        for idx in range(source_files_count.pop()):
-            framelist.append(defaultdict(dict))
-            for sdir, signal, datatype, name, filelist in directories:
-                framelist[-1][signal][(datatype, name)] = filelist[idx]
+        first_patch = 0
+
+        for info in self.index.load():
+            frame = {'pulse': {}, 'echo': {}, 'info': info,
+                     'first_patch': first_patch}
+            first_patch += -(-info['points'] // self.patch_size)
+            for subdir, filename in zip(self.index.subdirs, info['files']):
+                signal, datatype, name = subtree_pattern.match(subdir).groups()
+                frame[signal][(datatype, name)] = os.path.join(
+                    self.basedir, subdir, filename)
+            if self.frame_may_match(frame, bounds, patch_bounds):
+                framelist.append(frame)
 
         # start reading and creating patches
-        for patch in self.generate_patch(framelist):
+        for patch in self.generate_patch(
+                framelist, bounds, patch_bounds, columns):
             yield patch
 
-    def generate_patch(self, framelist):
+    def get_rel_size(self, quals, columns):
         """
-        Using dimensional compression since datasource is already arranged by dimension
-        # byte:          endianness (1 = NDR, 0 = XDR)
-        # uint32:        pcid (key to POINTCLOUD_SCHEMAS)
-        # uint32:        2 = dimensional compression
-        # uint32:        npoints
-        # dimensions[]:  dimensionally compressed data for each dimension
-
-        + one header for each dimension
-
-        # byte:           dimensional compression type (0-3)
-        # uint32:         size of the compressed dimension in bytes
-        # data[]:         the compressed dimensional values
-
-        """  # NOQA
-        for idx, frame in enumerate(framelist):
-            # read frame
-            att_array = self.read_ept(frame)
-            att_size = len(att_array[0][1])
-            # generating slices for accessing subarrays
-            # [slice(0, 100),
-            #  slice(100, 200),
-            #  slice(200, 300)...]
-            slices = [
-                slice(a, b)
-                for a, b in zip(
-                    range(0, att_size, self.patch_size),
-                    range(self.patch_size, att_size, self.patch_size)
-                )
-            ]
-            if slices[-1].stop != att_size:
-                # append the end of the array
-                slices.append(slice(slices[-1].stop, att_size))
-
-            for sli in slices:
-                buff = [
-                    pack('<bI', 0, values.nbytes) +  # header for each dim
-                    values.tostring()  # data content
-                    for _, att in att_array
-                    for values in [att[sli]]
-                ]
-                header = pack('<b3I', 1, self.pcid, 2, sli.stop - sli.start)
-                yield {'points': hexlify(header + b''.join(buff))}
-
-    def read_ept(self, frame):
-        # read first linear time and pop it
-        pulses = frame['pulse']
-        timefile = pulses.pop(('linear', 'time'))
-        with open(timefile, 'r') as tfile:
-            nentries, _, t0, _, delta, _ = tfile.readline().split()
-            nentries = int(nentries)
-            t0 = float(t0) + self.time_offset
-            delta = float(delta)
-
-        # we have to read nentries in pulse files, let's go
-        # initialize pulse array for this file
-        pulse_arrays = {}
-        for (datatype, name), filename in pulses.items():
-            values = np.fromfile(str(filename), dtype=datatype, count=nentries)
-            pulse_arrays[name] = values
-
-        # compute time values and reference it
-        pulse_arrays['time'] = (
-            np.ones(nentries, dtype='float64') * t0 +
-            np.arange(nentries, dtype='float64') * delta
-        )
-        echo_arrays = {}
-        echos = frame['echo']
-
-        vec_echo = pulse_arrays['n_echo']
-        nechos = np.sum(vec_echo)
-
-        # get zero indices and scale to indices in echo space !
-        # astype needed -> https://github.com/numpy/numpy/issues/6198
-        zero_indices = vec_echo.cumsum()[vec_echo == 0].astype('int64')
+        Estimate the number of rows and their width for the planner, from
+        the points of the indexed frames inside the time and patch_id quals
+        """
+        if self.metadata:
+            return 1, len(self.read_pcschema())
+        point_size = sum(int(size) for _, size, _, _ in self.ordered_dims)
+        width = patch_width(self.patch_size, point_size, self.output,
+                            len(self.ordered_dims))
+        width += 8 * len(set(columns or ()) & set(['time', 'patch_id']))
+        if len(self.source_dirs) < 8:
+            return 1, width
+
+        bounds = get_bounds(quals, 'time')
+        patch_bounds = get_bounds(quals, 'patch_id')
+        rows = 0.
+        first_patch = 0
+        for info in self.index.load():
+            npatches = -(-info['points'] // self.patch_size)
+            if info['pulses']:
+                tmin = info['t0'] + self.time_offset
+                tmax = tmin + (info['pulses'] - 1) * info['delta']
+                rows += npatches * bounded_fraction(tmin, tmax, bounds) * \
+                    bounded_fraction(first_patch, first_patch + npatches - 1, patch_bounds)
+            first_patch += npatches
+        return max(int(math.ceil(rows)), 1), width
+
+    def get_path_keys(self):
+        """
+        A patch_id or a time selects a single patch
+        """
+        if self.metadata:
+            return []
+        return [(('patch_id', ), 1), (('time', ), 1)]
 
-        for (datatype, name), filename in echos.items():
-            values = np.fromfile(str(filename), dtype=datatype, count=nechos)
-            echo_arrays[name] = np.insert(values, zero_indices, 0)
+    def frame_may_match(self, frame, bounds, patch_bounds):
+        """
+        Checks, without reading it, if a frame can contain pulses inside
+        the time bounds and patches inside the patch number bounds.
+        """
+        info = frame['info']
+        if not info['pulses']:
+            return False
+        tmin = info['t0'] + self.time_offset
+        tmax = tmin + (info['pulses'] - 1) * info['delta']
+        last_patch = frame['first_patch'] + \
+            (info['points'] - 1) // self.patch_size
+        return overlaps(tmin, tmax, bounds) and \
+            overlaps(frame['first_patch'], last_patch, patch_bounds)
+
+    def generate_patch(self, framelist, bounds=(None, None),
+                       patch_bounds=(None, None), columns=None):
+        """
+        Decode frames to patches, in time order.
+        With the workers option, upcoming frames are decoded in a pool while
+        previous ones are sent to PostgreSQL.
+        """
+        decoder = FrameDecoder(
+            self.pcid, self.patch_size, self.time_offset,
+            [name for _, _, name, _ in self.ordered_dims],
+            bounds, patch_bounds, columns, self.compression, self.output)
+
+        if not self.workers:
+            for frame in framelist:
+                for row in decoder.patches(frame):
+                    yield row
+            return
 
-        # add the echo index as a new dimension
-        echo_arrays['echo'] = np.fromiter([
-            idx
-            for ne in vec_echo
-            for idx in range(ne)],
-            dtype='uint8')
-        # apply zero insert
-        echo_arrays['echo'] = np.insert(
-            echo_arrays['echo'], zero_indices, 0).astype('uint8')
-
-        # Duplicate all items in pulse arrays according to n_echo number
-        # We must create a copy of n_echo array with zero values replaced
-        # by 1 in order to repeat correctly items without deleting zero items
-        n_echo_copy = pulse_arrays['n_echo'].copy()
-
-        # remove zero value in order to use the repeat function without
-        # deleting rows
-        n_echo_copy[n_echo_copy == 0] = 1
-
-        # duplicate rows having more than 1 echoe
-        for name, p in pulse_arrays.items():
-            pulse_arrays[name] = pulse_arrays[name].repeat(n_echo_copy)
-
-        pulse_arrays.update(echo_arrays)
-        # return ordered arrays according to xml schema
-        return sorted(
-            pulse_arrays.items(),
-            key=lambda x: self.raw_dimensions.index(x[0])
-        )
+        for rows in ordered_imap(decoder, framelist, self.workers,
+                                 self.prefetch, self.worker_type):
+            for row in rows:
+                yield row
@@ -5,7 +5,9 @@ from collections import namedtuple
 import xml.etree.ElementTree as etree
 
 from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR
 
+from .pcpatch import COMPRESSIONS, OUTPUTS
 from .util import strtobool
 
 
@@ -15,6 +17,19 @@ dimension = namedtuple('dimensions', ['name', 'size', 'type', 'scale'])
 PC_NAMESPACE = '{http://pointcloud.org/schemas/PC/1.1}'
 
 
+def get_output(options):
+    """
+    Returns the output option: patches are hex encoded for a pcpatch column
+    (default), or raw bytes for a bytea column
+    """
+    output = options.get('output', 'hex')
+    if output not in OUTPUTS:
+        log_to_postgres(
+            'unknown output: {}'.format(output), ERROR,
+            hint='supported outputs: {}'.format(', '.join(OUTPUTS)))
+    return output
+
+
 class ForeignPcBase(ForeignDataWrapper):
     """
     Foreign PointCloud Base class
@@ -35,6 +50,14 @@ class ForeignPcBase(ForeignDataWrapper):
         self.metadata = strtobool(options.get('metadata', 'false'))
         # get time offset if provided
         self.time_offset = float(options.get('time_offset', 0))
+        # compression of each dimension in patches (see pcpatch.COMPRESSIONS)
+        self.compression = options.get('compression', 'none')
+        if self.compression not in COMPRESSIONS:
+            log_to_postgres(
+                'unknown compression: {}'.format(self.compression), ERROR,
+                hint='supported compressions: {}'.format(
+                    ', '.join(sorted(COMPRESSIONS))))
+        self.output = get_output(options)
         # will store dimension infos
         self._dimensions = None
 
@@ -3,10 +3,12 @@
 import math
 import random
 import time
-from binascii import hexlify
 from struct import Struct, pack
 from multicorn import ForeignDataWrapper
 
+from .foreignpc import get_output
+from .pcpatch import format_patch
+
 
 class PatchSample(ForeignDataWrapper):
     """PatchSample is a PostgreSQL multicorn foreign data wrapper
@@ -16,6 +18,7 @@ class PatchSample(ForeignDataWrapper):
         - npy : number of patches on y
         - nppp : number of point per patch
         - space : distance between two points in a patch
+        - output : hex (default) for a pcpatch column, bytea for a bytea column
     """
 
     def __init__(self, options, columns):
@@ -25,13 +28,15 @@ class PatchSample(ForeignDataWrapper):
         self.npy = int(options['npy'])
         self.nppp = int(options['nppp'])
         self.space = float(options['space'])
+        self.output = get_output(options)
 
     def execute(self, quals, columns):
-        for patch in gen_patches(self.npx, self.npy, self.nppp, self.space):
+        for patch in gen_patches(self.npx, self.npy, self.nppp, self.space,
+                                 self.output):
             yield patch
 
 
-def gen_patches(npx, npy, nppp, space):
+def gen_patches(npx, npy, nppp, space, output='hex'):
 
     # PCPatch structure
     #
@@ -67,9 +72,8 @@ def gen_patches(npx, npy, nppp, space):
                             j * pppsqrt * space + l * space,
                             0.0,
                             random.random()))
-            hexa = hexlify(header + b''.join(points))
             yield {
-                'points': hexa
+                'points': format_patch(header + b''.join(points), output)
             }
 
 
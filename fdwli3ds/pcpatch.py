@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Writer of pgPointCloud dimensional patches.
+
+Each dimension of a patch can be stored with its own compression, the
+formats are those of pgPointCloud (see lib/pc_bytes.c):
+
+    - none: raw values
+    - run-length: (uint8 run length, value) pairs, runs are at most 255 long
+    - significant bits: a header of two words (number of unique bits, common
+      value) followed by the unique bits of each value, packed from the most
+      significant bit in words of the dimension size
+    - zlib: raw values compressed with zlib
+
+Patches are built in a single buffer, header included, and handed over to
+PostgreSQL either hex encoded (for a pcpatch column) or as raw bytes
+(for a bytea column, see format_patch).
+"""
+import zlib
+from struct import pack, pack_into
+from binascii import hexlify
+import xml.etree.ElementTree as etree
+
+import numpy as np
+
+# dimensional compression types
+PC_DIM_NONE = 0
+PC_DIM_RLE = 1
+PC_DIM_SIGBITS = 2
+PC_DIM_ZLIB = 3
+
+# values of the compression option
+COMPRESSIONS = {
+    'none': PC_DIM_NONE,
+    'rle': PC_DIM_RLE,
+    'sigbits': PC_DIM_SIGBITS,
+    'zlib': PC_DIM_ZLIB,
+    # cheapest compression for each dimension of each patch
+    'auto': None,
+}
+
+# values of the output option
+OUTPUTS = ('hex', 'bytea')
+
+# longest run in run-length encoding
+MAX_RUN = 255
+
+# pointcloud interpretations not understood by numpy
+INTERPRETATIONS = {
+    'int8_t': 'i1',
+    'uint8_t': 'u1',
+    'int16_t': 'i2',
+    'uint16_t': 'u2',
+    'int32_t': 'i4',
+    'uint32_t': 'u4',
+    'int64_t': 'i8',
+    'uint64_t': 'u8',
+    'float': 'f4',
+}
+
+
+def interpretation_dtype(interpretation):
+    """
+    Returns the little-endian numpy dtype of a pointcloud interpretation
+    """
+    return np.dtype(
+        INTERPRETATIONS.get(interpretation, interpretation)).newbyteorder('<')
+
+
+def schema_dtype(schema, byteorder='<'):
+    """
+    Returns the numpy structured dtype of the points described by a
+    pointcloud xml schema
+    """
+    namespace = '{http://pointcloud.org/schemas/PC/1.1}'
+    dims = sorted(
+        (int(elem.findtext(namespace + 'position')),
+         str(elem.findtext(namespace + 'name')),
+         elem.findtext(namespace + 'interpretation'))
+        for elem in etree.fromstring(schema).iter(namespace + 'dimension')
+    )
+    return np.dtype([
+        (name, interpretation_dtype(interpretation).newbyteorder(byteorder))
+        for _, name, interpretation in dims
+    ])
+
+
+def little_endian(values):
+    """
+    Returns contiguous values in little-endian byte order
+    """
+    return np.ascontiguousarray(
+        values, dtype=values.dtype.newbyteorder('<'))
+
+
+def as_words(values):
+    """
+    View values as unsigned integers of the same size, used to compare
+    values bitwise (nan included)
+    """
+    return values.view('<u{}'.format(values.itemsize))
+
+
+def run_lengths(words):
+    """
+    Returns the start index and the length of each run of equal values
+    """
+    starts = np.flatnonzero(np.r_[True, words[1:] != words[:-1]])
+    return starts, np.diff(np.r_[starts, len(words)])
+
+
+def rle_encode(words):
+    starts, lengths = run_lengths(words)
+    # runs longer than MAX_RUN are split in several chunks
+    nchunks = (lengths + MAX_RUN - 1) // MAX_RUN
+    run = np.repeat(np.arange(len(starts)), nchunks)
+    chunk = np.arange(len(run)) - np.repeat(nchunks.cumsum() - nchunks, nchunks)
+    encoded = np.empty(len(run), dtype=[('count', 'u1'), ('value', words.dtype)])
+    encoded['count'] = np.minimum(lengths[run] - chunk * MAX_RUN, MAX_RUN)
+    encoded['value'] = words[starts[run]]
+    return encoded.tostring()
+
+
+def rle_size(words):
+    _, lengths = run_lengths(words)
+    return int(((lengths + MAX_RUN - 1) // MAX_RUN).sum()) * (1 + words.itemsize)
+
+
+def sigbits_count(words):
+    """
+    Returns the number of unique (low) bits and the common value
+    (shared high bits) of words
+    """
+    common_and = int(np.bitwise_and.reduce(words))
+    common_or = int(np.bitwise_or.reduce(words))
+    nbits = (common_and ^ common_or).bit_length()
+    return nbits, common_and >> nbits << nbits
+
+
+def sigbits_encode(words):
+    nbits, commonvalue = sigbits_count(words)
+    bitwidth = words.itemsize * 8
+    header = np.array([nbits, commonvalue], dtype=words.dtype)
+    if not nbits:
+        # a single padding word, as pgPointCloud does
+        return header.tostring() + np.zeros(1, dtype=words.dtype).tostring()
+    shifts = np.arange(nbits - 1, -1, -1)
+    bits = ((words[:, None] >> shifts) & 1).astype('u1').ravel()
+    nwords = -(-len(bits) // bitwidth)
+    bits = np.r_[bits, np.zeros(nwords * bitwidth - len(bits), dtype='u1')]
+    # bits are packed in big-endian words, stored in little-endian order
+    packed = np.packbits(bits).view('>u{}'.format(words.itemsize))
+    return header.tostring() + packed.astype(words.dtype).tostring()
+
+
+def sigbits_size(words):
+    nbits, _ = sigbits_count(words)
+    nwords = max(-(-len(words) * nbits // (words.itemsize * 8)), 1)
+    return (2 + nwords) * words.itemsize
+
+
+def encode_dimension(values, compression='none'):
+    """
+    Encode the values of one dimension of a patch.
+    compression is one of COMPRESSIONS keys, a compression which does not
+    apply to the values falls back to none.
+    Returns the compression type and the encoded bytes (the little-endian
+    values themselves when not compressed, to avoid a copy).
+    """
+    values = little_endian(values)
+    if compression == 'none' or not len(values):
+        return PC_DIM_NONE, values
+
+    words = as_words(values)
+    # significant bits are only used on 8, 16 and 32 bits words
+    sigbits = values.itemsize in (1, 2, 4)
+    if compression == 'rle':
+        return PC_DIM_RLE, rle_encode(words)
+    if compression == 'sigbits':
+        if sigbits:
+            return PC_DIM_SIGBITS, sigbits_encode(words)
+        return PC_DIM_NONE, values
+    if compression == 'zlib':
+        return PC_DIM_ZLIB, zlib.compress(values.tostring())
+
+    # automatic choice, ties are won by the cheapest to decode
+    candidates = [(values.nbytes, PC_DIM_NONE), (rle_size(words), PC_DIM_RLE)]
+    if sigbits:
+        candidates.append((sigbits_size(words), PC_DIM_SIGBITS))
+    zipped = zlib.compress(values.tostring())
+    candidates.append((len(zipped), PC_DIM_ZLIB))
+    _, ctype = min(candidates)
+    if ctype == PC_DIM_RLE:
+        return ctype, rle_encode(words)
+    if ctype == PC_DIM_SIGBITS:
+        return ctype, sigbits_encode(words)
+    if ctype == PC_DIM_ZLIB:
+        return ctype, zipped
+    return ctype, values
+
+
+def decode_dimension(ctype, data, dtype, npoints):
+    """
+    Decode the bytes of one dimension of a patch.
+    Returns a numpy array
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    words_type = np.dtype('<u{}'.format(dtype.itemsize))
+    if ctype == PC_DIM_RLE:
+        runs = np.frombuffer(data, dtype=[('count', 'u1'), ('value', words_type)])
+        return np.repeat(runs['value'], runs['count']).view(dtype)
+    if ctype == PC_DIM_SIGBITS:
+        nbits, commonvalue = np.frombuffer(data[:2 * dtype.itemsize], words_type)
+        packed = np.frombuffer(data[2 * dtype.itemsize:], words_type)
+        bits = np.unpackbits(
+            packed.astype('>u{}'.format(dtype.itemsize)).view('u1'))
+        bits = bits[:npoints * nbits].reshape(npoints, nbits)
+        words = np.zeros(npoints, dtype=words_type) + commonvalue
+        for idx in range(nbits):
+            words |= np.left_shift(bits[:, idx].astype(words_type),
+                                   words_type.type(nbits - 1 - idx))
+        return words.view(dtype)
+    if ctype == PC_DIM_ZLIB:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=dtype)
+
+
+def write_data(patch, offset, data):
+    """
+    Copy data (bytes or a contiguous array) in the patch buffer at offset.
+    Returns the offset following the data
+    """
+    data = np.frombuffer(data, dtype='u1')
+    memoryview(patch)[offset:offset + len(data)] = memoryview(data)
+    return offset + len(data)
+
+
+def dimensional_patch(pcid, arrays, compression='none'):
+    """
+    Build a patch with dimensional compression from a list of arrays,
+    one for each dimension of the schema (in order)
+
+    # byte:          endianness (1 = NDR, 0 = XDR)
+    # uint32:        pcid (key to POINTCLOUD_SCHEMAS)
+    # uint32:        2 = dimensional compression
+    # uint32:        npoints
+    # dimensions[]:  dimensionally compressed data for each dimension
+
+    + one header for each dimension
+
+    # byte:           dimensional compression type (0-3)
+    # uint32:         size of the compressed dimension in bytes
+    # data[]:         the compressed dimensional values
+
+    Returns a bytearray
+    """
+    encoded = [encode_dimension(values, compression) for values in arrays]
+    sizes = [np.frombuffer(data, dtype='u1').nbytes for _, data in encoded]
+    patch = bytearray(13 + 5 * len(encoded) + sum(sizes))
+    pack_into('<b3I', patch, 0, 1, pcid, 2, len(arrays[0]))
+    offset = 13
+    for (ctype, data), size in zip(encoded, sizes):
+        pack_into('<bI', patch, offset, ctype, size)
+        offset = write_data(patch, offset + 5, data)
+    return patch
+
+
+def point_patch(pcid, npoints, chunks, endianness=1):
+    """
+    Build an uncompressed patch from chunks of packed points (bytes or
+    structured arrays), written one after the other
+
+    # byte:         endianness (1 = NDR, 0 = XDR)
+    # uint32:       pcid (key to POINTCLOUD_SCHEMAS)
+    # uint32:       0 = no compression
+    # uint32:       npoints
+    # pointdata[]:  interpret relative to pcid
+
+    Returns a bytearray
+    """
+    # the header is packed in the patch buffer, which is then extended in
+    # place with the points (cheaper than zeroing a preallocated buffer)
+    patch = bytearray(pack('<b3I' if endianness else '>b3I',
+                           endianness, pcid, 0, npoints))
+    for chunk in chunks:
+        patch += memoryview(np.frombuffer(chunk, dtype='u1'))
+    return patch
+
+
+def format_patch(patch, output='hex'):
+    """
+    Prepare a patch for PostgreSQL according to the output option:
+    hex encoded for a pcpatch column, or raw bytes for a bytea column
+    (converted in SQL with encode(points, 'hex')::pcpatch)
+    """
+    if output == 'bytea':
+        return bytes(patch)
+    return hexlify(patch)
+
+
+def patch_width(npoints, point_size, output='hex', ndims=0):
+    """
+    Size of an uncompressed patch of npoints as handed over to PostgreSQL,
+    used to report the width of rows to the planner. Dimensional patches
+    have a header for each of their ndims dimensions.
+    """
+    size = 13 + 5 * ndims + npoints * point_size
+    return size if output == 'bytea' else 2 * size
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vectorized map projections of geographic coordinates (radians) to the
+metric coordinate systems commonly used with trajectories:
+
+    - transverse Mercator (UTM zones), using the 6th order Krüger series
+      (Karney 2011, accurate to the millimeter within zones)
+    - Lambert conformal conic with two standard parallels (Lambert-93 and
+      the French conic conformal zones)
+
+Datum shifts are not applied: WGS84, ETRS89 and RGF93 are considered equal.
+"""
+import numpy as np
+
+# semi-major axis and flattening
+WGS84 = (6378137., 1 / 298.257223563)
+GRS80 = (6378137., 1 / 298.257222101)
+
+
+class TransverseMercator(object):
+
+    def __init__(self, ellipsoid, lon0, k0=0.9996, x0=500000., y0=0.):
+        a, f = ellipsoid
+        self.e = np.sqrt(f * (2 - f))
+        self.lon0 = np.radians(lon0)
+        self.x0, self.y0 = x0, y0
+        n = f / (2 - f)
+        self.scale = k0 * a / (1 + n) * (
+            1 + n ** 2 / 4 + n ** 4 / 64 + n ** 6 / 256)
+        self.alpha = [
+            n / 2 - 2 * n ** 2 / 3 + 5 * n ** 3 / 16 + 41 * n ** 4 / 180 -
+            127 * n ** 5 / 288 + 7891 * n ** 6 / 37800,
+            13 * n ** 2 / 48 - 3 * n ** 3 / 5 + 557 * n ** 4 / 1440 +
+            281 * n ** 5 / 630 - 1983433 * n ** 6 / 1935360,
+            61 * n ** 3 / 240 - 103 * n ** 4 / 140 + 15061 * n ** 5 / 26880 +
+            167603 * n ** 6 / 181440,
+            49561 * n ** 4 / 161280 - 179 * n ** 5 / 168 +
+            6601661 * n ** 6 / 7257600,
+            34729 * n ** 5 / 80640 - 3418889 * n ** 6 / 1995840,
+            212378941 * n ** 6 / 319334400,
+        ]
+
+    def __call__(self, lon, lat):
+        """
+        Project arrays of longitudes and latitudes (radians).
+        Returns arrays of eastings and northings (meters)
+        """
+        lon = lon - self.lon0
+        # tangent of the conformal latitude
+        sin_lat = np.sin(lat)
+        tau = np.sinh(np.arctanh(sin_lat) - self.e * np.arctanh(self.e * sin_lat))
+        xi = np.arctan2(tau, np.cos(lon))
+        eta = np.arctanh(np.sin(lon) / np.sqrt(1 + tau ** 2))
+        x, y = eta.copy(), xi.copy()
+        for j, alpha in enumerate(self.alpha, 1):
+            x += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+            y += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        return self.x0 + self.scale * x, self.y0 + self.scale * y
+
+
+class LambertConformalConic(object):
+
+    def __init__(self, ellipsoid, lon0, lat0, lat1, lat2, x0, y0):
+        a, f = ellipsoid
+        self.e = np.sqrt(f * (2 - f))
+        self.lon0 = np.radians(lon0)
+        self.x0, self.y0 = x0, y0
+        lat0, lat1, lat2 = np.radians([lat0, lat1, lat2])
+        m1, m2 = self.m(lat1), self.m(lat2)
+        t1, t2 = self.t(lat1), self.t(lat2)
+        self.n = (np.log(m1) - np.log(m2)) / (np.log(t1) - np.log(t2))
+        self.scale = a * m1 / (self.n * t1 ** self.n)
+        self.r0 = self.scale * self.t(lat0) ** self.n
+
+    def m(self, lat):
+        return np.cos(lat) / np.sqrt(1 - (self.e * np.sin(lat)) ** 2)
+
+    def t(self, lat):
+        e_sin_lat = self.e * np.sin(lat)
+        return np.tan(np.pi / 4 - lat / 2) / (
+            (1 - e_sin_lat) / (1 + e_sin_lat)) ** (self.e / 2)
+
+    def __call__(self, lon, lat):
+        """
+        Project arrays of longitudes and latitudes (radians).
+        Returns arrays of eastings and northings (meters)
+        """
+        r = self.scale * self.t(lat) ** self.n
+        theta = self.n * (lon - self.lon0)
+        return self.x0 + r * np.sin(theta), self.y0 + self.r0 - r * np.cos(theta)
+
+
+def utm(ellipsoid, zone, north=True):
+    return TransverseMercator(
+        ellipsoid, zone * 6 - 183, y0=0. if north else 10000000.)
+
+
+def projection(srid):
+    """
+    Returns the projection of a supported srid, None otherwise
+    """
+    if 32601 <= srid <= 32660:
+        # WGS 84 / UTM zones north
+        return utm(WGS84, srid - 32600)
+    if 32701 <= srid <= 32760:
+        # WGS 84 / UTM zones south
+        return utm(WGS84, srid - 32700, north=False)
+    if 25828 <= srid <= 25838:
+        # ETRS89 / UTM zones
+        return utm(GRS80, srid - 25800)
+    if srid == 2154:
+        # RGF93 / Lambert-93
+        return LambertConformalConic(GRS80, 3, 46.5, 44, 49, 700000., 6600000.)
+    if 3942 <= srid <= 3950:
+        # RGF93 / CC42 to CC50
+        lat0 = srid - 3900
+        return LambertConformalConic(
+            GRS80, 3, lat0, lat0 - 0.75, lat0 + 0.75,
+            1700000., (lat0 - 41) * 1000000. + 200000.)
+    return None
@@ -1,11 +1,21 @@
+import os
+import json
 from sys import byteorder
-from struct import pack, unpack, calcsize
-from binascii import hexlify
+from glob import glob
+from heapq import heappush, heappop
+from struct import Struct, unpack_from
+from collections import namedtuple, OrderedDict, deque
+from functools import partial
+from operator import attrgetter, methodcaller, eq, ne, lt, le, gt, ge
 
+import numpy as np
 from multicorn import ForeignDataWrapper, ColumnDefinition, TableDefinition
 from multicorn.utils import log_to_postgres, ERROR, WARNING
 
-from .util import strtobool
+from .pcpatch import (COMPRESSIONS, OUTPUTS, dimensional_patch, point_patch,
+                      format_patch, patch_width, schema_dtype)
+from .util import (strtobool, get_bounds, get_values, bounded_fraction, read_ahead,
+                   save_json)
 
 
 struct_fmt_dict = {
@@ -71,14 +81,85 @@ def get_schema_and_fmt(patch_columns, columns):
     return schema, fmt
 
 
-def get_point_data(row, columns, fmt):
+def get_point_data(row, columns, point_struct):
     val = list()
     for column in columns:
         if isinstance(row[column], tuple):
             val.extend(row[column])
         else:
             val.append(row[column])
-    return pack(fmt, *val)
+    return point_struct.pack(*val)
+
+
+def get_attr(msg, column):
+    """
+    Read a dotted column of a message, a list of sub messages gives a tuple
+    """
+    attr = msg
+    for col in column.split('.'):
+        if isinstance(attr, list):
+            attr = tuple(getattr(a, col) for a in attr)
+        else:
+            attr = getattr(attr, col)
+    return attr
+
+
+def compile_getter(msg, column):
+    """
+    Returns a function reading a dotted column of messages of the same type
+    as msg (an attrgetter unless lists of sub messages are traversed), and
+    the value of msg
+    """
+    attr = msg
+    for col in column.split('.'):
+        if isinstance(attr, list):
+            return partial(get_attr, column=column), get_attr(msg, column)
+        attr = getattr(attr, col)
+    return attrgetter(column), attr
+
+
+def compile_converter(value, fmt):
+    """
+    Returns the function converting values like value to column values
+    (None if they are used as is): times to nanoseconds, vectors and
+    quaternions to tuples, and binary strings to tuples with fmt
+    """
+    if hasattr(value, "to_nsec"):
+        return methodcaller("to_nsec")
+    if hasattr(value, "x"):
+        if hasattr(value, "w"):
+            return attrgetter("x", "y", "z", "w")
+        return attrgetter("x", "y", "z")
+    if isinstance(value, str) and fmt:
+        return Struct(fmt).unpack
+    return None
+
+
+# operators of the quals evaluated by the wrapper
+OPERATORS = {'=': eq, '<>': ne, '!=': ne, '<': lt, '<=': le, '>': gt, '>=': ge}
+
+
+def compile_qual(qual):
+    """
+    Returns a function checking a column value against a qual (a scalar or
+    an ANY/ALL array operator), None if the qual is not supported
+    """
+    if isinstance(qual.operator, tuple):
+        operator, is_any = qual.operator
+        op = OPERATORS.get(operator)
+        if op is None or qual.value is None or None in qual.value:
+            return None
+        values = list(qual.value)
+        if op is eq and is_any:
+            values = set(values)
+            return lambda value: value in values
+        if is_any:
+            return lambda value: any(op(value, v) for v in values)
+        return lambda value: all(op(value, v) for v in values)
+    op = OPERATORS.get(qual.operator)
+    if op is None or qual.value is None:
+        return None
+    return lambda value, v=qual.value: op(value, v)
 
 
 def get_fields_with_extra_bytes(msg):
@@ -98,6 +179,71 @@ def get_fields_with_extra_bytes(msg):
         offset += 1
 
 
+# numpy types of the PointField datatypes (minus one)
+POINTFIELD_DTYPES = ['i1', 'u1', 'i2', 'u2', 'i4', 'u4', 'f4', 'f8']
+
+
+def pointcloud_dtype(msg, names):
+    """
+    Returns the numpy structured dtype viewing the named fields of the points
+    of a PointCloud2 message (padding can be selected as extra_byte_N), and
+    the dtype of the same fields packed without padding
+    """
+    byteorder = '>' if msg.is_bigendian else '<'
+    view = {'names': [], 'formats': [], 'offsets': [], 'itemsize': msg.point_step}
+    offset = 0
+    for datatype, name in get_fields_with_extra_bytes(msg):
+        fmt = byteorder + POINTFIELD_DTYPES[datatype]
+        if name in names:
+            view['names'].append(name)
+            view['formats'].append(fmt)
+            view['offsets'].append(offset)
+        offset += np.dtype(fmt).itemsize
+    packed = list(zip(view['names'], view['formats']))
+    return np.dtype(view), np.dtype(packed)
+
+
+def voxel_keys(voxels):
+    """
+    Returns one integer key for each row of voxel indices, combined in a
+    single int64 when the extent of the voxels allows it
+    """
+    voxels = voxels - voxels.min(axis=0)
+    span = voxels.max(axis=0) + 1
+    if int(span[0]) * int(span[1]) * int(span[2]) < 1 << 62:
+        return (voxels[:, 0] * span[1] + voxels[:, 1]) * span[2] + voxels[:, 2]
+    return np.ascontiguousarray(voxels).view([('', 'i8')] * 3).ravel()
+
+
+def filter_points(points, voxel_size=0, range_min=0, range_max=0, drop_nan=False):
+    """
+    Select points from a structured array with x, y and z fields: points
+    with a nan coordinate are dropped (also by the range and voxel filters),
+    then points out of [range_min, range_max] meters from the sensor, then
+    all points but the first of each voxel of a grid of voxel_size meters.
+    Returns the indices of the points kept, in order
+    """
+    x, y, z = (points[name].astype('f8') for name in ('x', 'y', 'z'))
+    keep = np.ones(len(points), dtype=bool)
+    if drop_nan or voxel_size:
+        keep &= np.isfinite(x) & np.isfinite(y) & np.isfinite(z)
+    if range_min or range_max:
+        distance = x * x + y * y + z * z
+        # comparisons with nan are false
+        with np.errstate(invalid='ignore'):
+            if range_min:
+                keep &= distance >= range_min * range_min
+            if range_max:
+                keep &= distance <= range_max * range_max
+    keep = np.flatnonzero(keep)
+    if voxel_size and len(keep):
+        voxels = np.floor(
+            np.column_stack((x[keep], y[keep], z[keep])) / voxel_size).astype('i8')
+        _, first = np.unique(voxel_keys(voxels), return_index=True)
+        keep = keep[np.sort(first)]
+    return keep
+
+
 def get_ply_header(fields):
     header = ("ply\n"
               "format binary_{endianness}_endian 1.0\n"
@@ -138,7 +284,7 @@ def get_schema(pyschema):
     return schema + '</pc:PointCloudSchema>\n'
 
 
-def get_columns(bag, topic, infos, pcid, patch_column, patch_columns):
+def get_columns(bag, topic, infos, pcid, patch_column, patch_columns, fields=None):
     # read the first message to introspect its type
     # internal connection api could have been used instead
     _, msg, _ = next(bag.read_messages(topics=topic))
@@ -147,6 +293,8 @@ def get_columns(bag, topic, infos, pcid, patch_column, patch_columns):
     patch_schema = None
     patch_ply_header = None
     endianness = 0
+    # points of the first message
+    message_points = 1
     res.append(("filename", ("string", "", 0, '')))
     res.append(("topic", ("string", "", 0, '')))
     res.append(("time", ("uint64", "", 0, 'Q')))
@@ -154,10 +302,20 @@ def get_columns(bag, topic, infos, pcid, patch_column, patch_columns):
         patch_columns = []
         res.append((patch_column, ("pcpatch", "", pcid, '')))
         res.append(("ply", ("bytea", "", 0, '')))
-        fields = list(get_fields_with_extra_bytes(msg))
-        patch_schema = get_schema(fields)
-        patch_ply_header = get_ply_header(fields)
+        pointfields = list(get_fields_with_extra_bytes(msg))
+        if fields:
+            # only the selected fields are kept in patches
+            names = [name for _, name in pointfields]
+            unknown = set(fields) - set(names)
+            if unknown:
+                log_to_postgres(
+                    'unknown fields: {}'.format(', '.join(sorted(unknown))), ERROR,
+                    hint='fields of {}: {}'.format(topic, ', '.join(names)))
+            pointfields = [field for field in pointfields if field[1] in fields]
+        patch_schema = get_schema(pointfields)
+        patch_ply_header = get_ply_header(pointfields)
         endianness = 0 if msg.is_bigendian else 1
+        message_points = msg.width * msg.height
 
     elif patch_column:
         # wildcard '*' selects, in sorted order, all numeric fields
@@ -171,7 +329,8 @@ def get_columns(bag, topic, infos, pcid, patch_column, patch_columns):
     has_lon = 'longitude' in patch_columns or 'lon' in patch_columns
     has_lat = 'latitude' in patch_columns or 'lat' in patch_columns
     patch_srid = 4326 if (has_lon and has_lat) else 0
-    return dict(res), patch_schema, patch_ply_header, endianness, patch_columns, patch_srid
+    return (dict(res), patch_schema, patch_ply_header, endianness, patch_columns, patch_srid,
+            message_points)
 
 
 def get_columns_from_message(msg, cols=[], typ_suffix=""):
@@ -212,6 +371,272 @@ def get_columns_from_message(msg, cols=[], typ_suffix=""):
             yield (".".join(subcols), (typ, subtyp_suffix, 0, struct_fmt(typ, subtyp_suffix)))
 
 
+RawHeader = namedtuple('RawHeader', ['seq', 'stamp', 'frame_id'])
+RawPointField = namedtuple('RawPointField', ['name', 'offset', 'datatype', 'count'])
+RawPointCloud2 = namedtuple('RawPointCloud2', [
+    'header', 'height', 'width', 'fields', 'is_bigendian', 'point_step',
+    'row_step', 'data', 'is_dense'])
+
+
+def parse_pointcloud2(raw):
+    """
+    Parse a serialized sensor_msgs/PointCloud2 message (always little-endian),
+    without deserializing it with genpy: the header fields are unpacked, the
+    stamp is given in nanoseconds and data is a uint8 array viewing raw
+    """
+    seq, secs, nsecs, size = unpack_from('<4I', raw, 0)
+    offset = 16 + size
+    frame_id = raw[16:offset]
+    height, width, nfields = unpack_from('<3I', raw, offset)
+    offset += 12
+    fields = []
+    for _ in range(nfields):
+        size, = unpack_from('<I', raw, offset)
+        name = raw[offset + 4:offset + 4 + size]
+        offset += 4 + size
+        fields.append(RawPointField(name, *unpack_from('<IBI', raw, offset)))
+        offset += 9
+    is_bigendian, point_step, row_step, size = unpack_from('<B3I', raw, offset)
+    offset += 13
+    data = np.frombuffer(raw, dtype='u1', count=size, offset=offset)
+    is_dense, = unpack_from('<B', raw, offset + size)
+    return RawPointCloud2(
+        RawHeader(seq, secs * 1000000000 + nsecs, frame_id), height, width,
+        fields, bool(is_bigendian), point_step, row_step, data, bool(is_dense))
+
+
+class PatchAssembler(object):
+    """
+    Accumulate packed points and cut patches of size bytes every step bytes
+    (a step smaller than size repeats the last points of a patch in the
+    next one).
+
+    Points are appended to a bytearray and patches are uint8 views of it,
+    the consumed head is only dropped when it is larger than the remaining
+    data: cutting a patch does not copy the tail, and appending is
+    amortized linear. Views must be released before appending.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def append(self, data):
+        if self.start and self.start >= len(self):
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += memoryview(data)
+
+    def view(self, size=None):
+        """
+        View of the first size bytes (all by default)
+        """
+        return np.frombuffer(self.buffer, dtype='u1', offset=self.start,
+                             count=len(self) if size is None else size)
+
+    def patches(self, size, step):
+        """
+        Yield views of size bytes while enough data is available
+        """
+        while len(self) >= size:
+            yield self.view(size)
+            self.start += step
+
+
+# messages of the first window read backwards, then doubled for each window
+# up to the maximum (lower for point clouds, which are large)
+REVERSE_WINDOW = 8
+REVERSE_WINDOW_MAX = 512
+REVERSE_WINDOW_MAX_POINTCLOUD = 16
+
+TopicInfo = namedtuple('TopicInfo', ['msg_type', 'message_count'])
+
+
+def from_json(value):
+    """
+    Strings decoded from json are unicode in python 2, back to str
+    """
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    if isinstance(value, dict):
+        return {from_json(k): from_json(v) for k, v in value.items()}
+    if str is bytes and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def merge_scans(scans):
+    """
+    Merge in time order the items of scans, given as (start time, iterator)
+    sorted by start time, each iterator yielding items ordered by their
+    first element (a time, or a negated time to merge in reverse order). An
+    iterator is only started when the merge reaches its start time, so that
+    sequential scans are read one after the other.
+    """
+    heap = []
+    # ties are broken by arrival, items themselves are not compared
+    order = 0
+    scans = deque(scans)
+    while heap or scans:
+        while scans and (not heap or scans[0][0] <= heap[0][0]):
+            _, scan = scans.popleft()
+            for item in scan:
+                heappush(heap, (item[0], order, item, scan))
+                order += 1
+                break
+        if not heap:
+            continue
+        _, _, item, scan = heappop(heap)
+        yield item
+        for item in scan:
+            heappush(heap, (item[0], order, item, scan))
+            order += 1
+            break
+
+
+class BagCatalog(object):
+    """
+    Introspection of a bag file: the type and message count of its topics,
+    the time range of its messages, and the columns derived from the first
+    message of a topic (see get_columns), which otherwise require opening
+    and indexing the bag.
+
+    Entries are kept in memory for the life of the backend and, if a
+    filename is given, cached in a json file shared by several bags. An
+    entry is reused as long as the size and the modification time of its
+    bag are unchanged. The bag itself is only opened when needed.
+    """
+    version = 1
+    # entries by bag path, shared by all the catalogs of a backend
+    memory = {}
+
+    def __init__(self, path, open_bag, filename=None):
+        self.path = path
+        self.open_bag = open_bag
+        self.filename = filename
+        self.bag = None
+        self.entry = None
+        self.modified = False
+
+    def get_bag(self):
+        if self.bag is None:
+            self.bag = self.open_bag(self.path, 'r')
+        return self.bag
+
+    def close(self):
+        if self.bag is not None:
+            self.bag.close()
+            self.bag = None
+
+    def read(self):
+        """
+        Returns the entries of the json file by bag path
+        """
+        cached = {}
+        try:
+            with open(self.filename) as f:
+                cached = from_json(json.load(f))
+        except (IOError, ValueError):
+            pass
+        if cached.get('version') != self.version:
+            return {}
+        return cached.get('bags', {})
+
+    def load(self):
+        """
+        Returns the entry of the bag. The bag is checked on every call, it is
+        introspected again once its size or modification time changed
+        """
+        stat = os.stat(self.path)
+
+        def valid(entry):
+            return entry is not None and entry['size'] == stat.st_size and \
+                entry['mtime'] == stat.st_mtime
+
+        if valid(self.entry):
+            return self.entry
+        if self.entry is not None:
+            # a handle opened before the bag changed has a stale index
+            self.close()
+        entry = self.memory.get(self.path)
+        if not valid(entry) and self.filename:
+            entry = self.read().get(self.path)
+            self.memory[self.path] = entry
+        if not valid(entry):
+            bag = self.get_bag()
+            topics = bag.get_type_and_topic_info().topics
+            entry = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'topics': [[topic, infos.msg_type, infos.message_count]
+                           for topic, infos in topics.items()],
+                'columns': {},
+            }
+            if topics:
+                # from the chunk index of the bag, in seconds
+                entry['start'] = bag.get_start_time()
+                entry['end'] = bag.get_end_time()
+            self.memory[self.path] = entry
+            self.modified = True
+        self.entry = entry
+        return entry
+
+    def save(self):
+        """
+        Write the entry of the bag to the json file, if it was modified
+        """
+        if not self.filename or not self.modified:
+            return
+        bags = self.read()
+        bags[self.path] = self.entry
+        try:
+            save_json(self.filename, {'version': self.version, 'bags': bags})
+            self.modified = False
+        except (IOError, OSError) as e:
+            log_to_postgres(
+                'rosbag catalog could not be saved: {}'.format(e), WARNING,
+                hint='use the catalog option to choose a writable location')
+
+    def topics(self):
+        """
+        Returns the TopicInfo of each topic, in the order of the bag
+        """
+        return OrderedDict(
+            (topic, TopicInfo(msg_type, count))
+            for topic, msg_type, count in self.load()['topics'])
+
+    def time_range(self):
+        """
+        Returns the first and last times of the messages in nanoseconds,
+        widened by a microsecond to account for the float seconds of the
+        bag index (None if the bag is empty)
+        """
+        entry = self.load()
+        if 'start' not in entry:
+            return None
+        return int(entry['start'] * 1e9) - 1000, int(entry['end'] * 1e9) + 1000
+
+    def columns(self, topic, pcid, patch_column, patch_columns, fields=None):
+        """
+        Returns the result of get_columns for a topic
+        """
+        entry = self.load()
+        key = json.dumps([topic, pcid, patch_column, patch_columns, fields])
+        if key not in entry['columns']:
+            entry['columns'][key] = get_columns(
+                self.get_bag(), topic, self.topics()[topic], pcid,
+                patch_column, patch_columns, fields)
+            self.modified = True
+        columns, schema, ply_header, endianness, patch_columns, srid, points = \
+            entry['columns'][key]
+        columns = {name: tuple(column) for name, column in columns.items()}
+        return (columns, schema, ply_header, endianness, list(patch_columns), srid,
+                points)
+
+
 def import_bag(options):
     import sys
     python_path = options.pop('python_path', None)
@@ -227,7 +652,18 @@ class Rosbag(ForeignDataWrapper):
     def __init__(self, options, columns=None):
         super(Rosbag, self).__init__(options, columns)
         Bag = import_bag(options)
-        self.filename = options.pop('rosbag_path', "") + options.pop('rosbag')
+        # a bag, or bags of a session given as a glob and/or a comma
+        # separated list
+        rosbag_path = options.pop('rosbag_path', "")
+        rosbag = options.pop('rosbag')
+        self.filenames = sorted(set(
+            filename for name in rosbag.split(',')
+            for filename in glob(rosbag_path + name.strip())))
+        if not self.filenames:
+            log_to_postgres(
+                'no bag file matches {}'.format(rosbag_path + rosbag), ERROR,
+                hint='rosbag is a bag path, a glob or a comma separated list')
+        self.filename = self.filenames[0]
         self.topic = options.pop('topic', None)
         pointcloud_formats = strtobool(options.pop('metadata', 'false'))
 
@@ -240,9 +676,60 @@ class Rosbag(ForeignDataWrapper):
         self.patch_count_pointcloud = int(options.pop('patch_count_pointcloud', 0))
         assert(self.patch_count_default > 0)
         assert(self.patch_count_pointcloud >= 0)
+        # fields of point clouds kept in patches (all by default, padding
+        # included as extra_byte_N fields)
+        self.fields = [
+            field.strip() for field in options.pop('fields', '').split(',')
+            if field.strip()] or None
+        # filters of the points of point clouds, in meters (0 => disabled)
+        self.voxel_size = float(options.pop('voxel_size', 0))
+        self.range_min = float(options.pop('range_min', 0))
+        self.range_max = float(options.pop('range_max', 0))
+        self.drop_nan = strtobool(options.pop('drop_nan', 'false'))
+        if min(self.voxel_size, self.range_min, self.range_max) < 0:
+            log_to_postgres(
+                'negative voxel_size, range_min or range_max', ERROR,
+                hint='use 0 to disable a filter')
+        if self.range_max and self.range_min > self.range_max:
+            log_to_postgres(
+                'range_min is greater than range_max', ERROR,
+                hint='range_min and range_max are distances in meters')
+        # number of messages read ahead in a thread (0: read in turn with
+        # building the rows)
+        self.prefetch = int(options.pop('prefetch', 0))
+        if self.prefetch < 0:
+            log_to_postgres(
+                'negative prefetch: {}'.format(self.prefetch), ERROR,
+                hint='use 0 to read messages without a thread')
         self.pcid = int(options.pop('pcid', 0))
-        self.bag = Bag(self.filename, 'r')
-        self.topics = self.bag.get_type_and_topic_info().topics
+        # compression of each dimension in patches (see pcpatch.COMPRESSIONS)
+        self.compression = options.pop('compression', 'none')
+        if self.compression not in COMPRESSIONS:
+            log_to_postgres(
+                'unknown compression: {}'.format(self.compression), ERROR,
+                hint='supported compressions: {}'.format(
+                    ', '.join(sorted(COMPRESSIONS))))
+        # patches are hex encoded (pcpatch column) or raw bytes (bytea column)
+        self.output = options.pop('output', 'hex')
+        if self.output not in OUTPUTS:
+            log_to_postgres(
+                'unknown output: {}'.format(self.output), ERROR,
+                hint='supported outputs: {}'.format(', '.join(OUTPUTS)))
+        self.patch_dtypes = {}
+        # topics and columns are read from the catalogs of the bags, which are
+        # only opened when introspection is needed and when scanning
+        catalog = options.pop('catalog', None)
+        self.catalogs = [BagCatalog(filename, Bag, catalog) for filename in self.filenames]
+        self.topics = OrderedDict()
+        for bag_catalog in self.catalogs:
+            for topic, infos in bag_catalog.topics().items():
+                if topic in self.topics:
+                    infos = infos._replace(message_count=(
+                        self.topics[topic].message_count + infos.message_count))
+                self.topics[topic] = infos
+            if len(self.catalogs) > 1:
+                # bags of a session are introspected one at a time
+                bag_catalog.close()
         self.pointcloud_formats = None
 
         if pointcloud_formats:
@@ -252,9 +739,10 @@ class Rosbag(ForeignDataWrapper):
                 if topic not in topics:
                     continue
                 infos = self.topics[topic]
-                columns, patch_schema, patch_ply_header, _, patch_columns, patch_srid = \
-                    get_columns(self.bag, topic, infos, self.pcid+i+1, self.patch_column,
-                                self.patch_columns)
+                columns, patch_schema, patch_ply_header, _, patch_columns, patch_srid, _ = \
+                    self.topic_catalog(topic).columns(
+                        topic, self.pcid+i+1, self.patch_column, self.patch_columns,
+                        self.fields)
                 self.pointcloud_formats.append({
                     'pcid': self.pcid+i+1,
                     'srid': patch_srid,
@@ -264,6 +752,7 @@ class Rosbag(ForeignDataWrapper):
                     'columns': patch_columns,
                     'ply_header': patch_ply_header,
                 })
+            self.save_catalogs()
             return
 
         if not self.topic:
@@ -271,9 +760,11 @@ class Rosbag(ForeignDataWrapper):
 
         self.infos = self.topics[self.topic]
         (self.columns, self.patch_schema, self.patch_ply_header, self.endianness,
-         self.patch_columns, self.patch_srid) = \
-            get_columns(self.bag, self.topic, self.infos, self.pcid, self.patch_column,
-                        self.patch_columns)
+         self.patch_columns, self.patch_srid, self.message_points) = \
+            self.topic_catalog(self.topic).columns(
+                self.topic, self.pcid, self.patch_column, self.patch_columns,
+                self.fields)
+        self.save_catalogs()
 
         if columns:
             missing = set(columns) - set(self.columns.keys())
@@ -290,6 +781,19 @@ class Rosbag(ForeignDataWrapper):
             log_to_postgres("extra unsupported options : {}".format(
                 options.keys()), WARNING)
 
+    def topic_catalog(self, topic):
+        """
+        Returns the catalog of the first bag with messages of topic
+        """
+        return next(c for c in self.catalogs if topic in c.topics())
+
+    def save_catalogs(self):
+        for bag_catalog in self.catalogs:
+            bag_catalog.save()
+            if len(self.catalogs) > 1:
+                # bags of a session are reopened one at a time when scanning
+                bag_catalog.close()
+
     @classmethod
     def import_schema(self, schema, srv_options, options,
                       restriction_type, restricts):
@@ -300,10 +804,12 @@ class Rosbag(ForeignDataWrapper):
         patch_columns = options.pop('patch_columns', '*').strip()
         patch_columns = [col.strip() for col in patch_columns.split(',') if col.strip()]
         filename = srv_options.pop('rosbag_path', "") + options.pop('rosbag_path', "") + schema
-        bag = Bag(filename, 'r')
+        # a catalog given as an import option is also given to the tables
+        catalog_option = options.pop('catalog', None)
+        catalog = BagCatalog(filename, Bag, catalog_option or srv_options.get('catalog'))
 
         tablecols = []
-        topics = bag.get_type_and_topic_info().topics
+        topics = catalog.topics()
         pcid_for_topic = {k: pcid+1+i for i, k in enumerate(topics.keys())}
         pointcloud_formats = True
         if restriction_type is 'limit':
@@ -325,54 +831,316 @@ class Rosbag(ForeignDataWrapper):
                 ColumnDefinition('ply_header', type_name='text'),
             ]
             tableopts = {'metadata': 'true', 'rosbag': schema, 'pcid': pcid_str}
+            if catalog_option:
+                tableopts['catalog'] = catalog_option
             tabledefs.append(TableDefinition("pointcloud_formats", columns=tablecols,
                                              options=tableopts))
 
         for topic, infos in topics.items():
             pcid = pcid_for_topic[topic]
-            columns, _, _, _, _, _ = get_columns(bag, topic, infos, pcid,
-                                                 patch_column, patch_columns)
+            columns = catalog.columns(topic, pcid, patch_column, patch_columns)[0]
             tablecols = [get_column_def(k, *v) for k, v in columns.items()]
             tableopts = {'topic': topic, 'rosbag': schema, 'pcid': str(pcid)}
+            if catalog_option:
+                tableopts['catalog'] = catalog_option
             tabledefs.append(TableDefinition(topic, columns=tablecols, options=tableopts))
+        catalog.save()
         return tabledefs
 
-    def execute(self, quals, columns):
+    def single_message_rows(self, columns):
+        """
+        Checks that rows of columns do not span several messages: point
+        clouds with a patch per message, and other topics when the patch
+        column is not among columns
+        """
+        if self.infos.msg_type == 'sensor_msgs/PointCloud2':
+            return not self.patch_count_pointcloud
+        return self.patch_column not in columns
+
+    def can_sort(self, sortkeys):
+        """
+        Rows are returned in time order. The reverse order is supported when
+        rows do not span several messages (see single_message_rows), whatever
+        the columns requested from the table.
+        """
+        if self.pointcloud_formats is not None or not sortkeys:
+            return []
+        key = sortkeys[0]
+        if key.attname != 'time':
+            return []
+        if key.is_reversed and not self.single_message_rows(self.columns):
+            return []
+        return [key]
+
+    def execute(self, quals, columns, sortkeys=None):
         if self.pointcloud_formats is not None:
             for f in self.pointcloud_formats:
                 yield f
             return
-        self.patch_data = ''
+        self.patch_data = PatchAssembler()
+        # compiled from the first message
+        self.accessors = None
+        # quals on scalar columns, checked before building the rows when
+        # rows do not span several messages (rows of other messages would
+        # change)
+        self.filter_quals = []
+        if self.single_message_rows(columns):
+            self.filter_quals = [
+                qual for qual in quals
+                if qual.field_name in self.columns and
+                qual.field_name not in ('time', 'filename', 'topic', 'ply', self.patch_column) and
+                not self.columns[qual.field_name][1]
+            ]
         from rospy.rostime import Time
-        tmin = None
-        tmax = None
-        for qual in quals:
-            if qual.field_name == "time":
-                t = int(qual.value)
-                t = Time(t / 1000000000, t % 1000000000)
-                if qual.operator in ['=', '>', '>=']:
-                    tmin = t
-                if qual.operator in ['=', '<', '<=']:
-                    tmax = t
-        for topic, msg, t in self.bag.read_messages(
-                topics=self.topic, start_time=tmin, end_time=tmax):
+        lower, upper = get_bounds(quals, 'time')
+        tmin = lower and lower[0]
+        tmax = upper and upper[0]
+        times = get_values(quals, 'time')
+        if times is not None:
+            if not times:
+                return
+            tmin = times[0] if tmin is None else max(tmin, times[0])
+            tmax = times[-1] if tmax is None else min(tmax, times[-1])
+        # bounds are float nanoseconds: they are widened by a microsecond,
+        # the quals being checked again by PostgreSQL
+        if tmin is not None:
+            tmin = int(tmin) - 1000
+            tmin = Time(tmin // 1000000000, tmin % 1000000000)
+        if tmax is not None:
+            tmax = int(tmax) + 1000
+            tmax = Time(tmax // 1000000000, tmax % 1000000000)
+        # point clouds are parsed from the serialized messages, unless the
+        # data column itself is requested
+        raw = self.infos.msg_type == 'sensor_msgs/PointCloud2' and 'data' not in columns
+        reverse = bool(sortkeys) and sortkeys[0].is_reversed
+        scans = []
+        for bag_catalog in self.catalogs:
+            # bags without the topic or outside the time quals are skipped
+            time_range = bag_catalog.time_range()
+            if self.topic not in bag_catalog.topics() or time_range is None:
+                continue
+            if tmin is not None and time_range[1] < tmin.to_nsec():
+                continue
+            if tmax is not None and time_range[0] > tmax.to_nsec():
+                continue
+            if reverse:
+                scans.append((-time_range[1], self.read_bag_reversed(
+                    bag_catalog, time_range, tmin, tmax, raw)))
+            else:
+                scans.append((time_range[0], self.read_bag(bag_catalog, tmin, tmax, raw)))
+        scans.sort(key=lambda scan: scan[0])
+        messages = self.read_messages(scans, raw)
+        if self.prefetch:
+            messages = read_ahead(messages, self.prefetch)
+        for filename, topic, msg, t in messages:
+            self.filename = filename
             for row in self.get_rows(topic, msg, t, columns):
                 yield row
 
         # flush leftover patch data
-        if self.patch_data and self.last_row:
+        if len(self.patch_data) and self.last_row:
             count = int((len(self.patch_data) / self.point_size))
             # in replicating mode, a single leftover point must not be reported
             if count > 1 or self.patch_step_size == self.patch_size:
                 res = self.last_row
                 if self.patch_column in columns:
-                    res[self.patch_column] = hexlify(
-                            pack('=b3I', self.endianness, self.pcid, 0, count) + self.patch_data)
+                    res[self.patch_column] = format_patch(
+                        self.make_patch(count, self.patch_data.view()), self.output)
                 if self.patch_ply_header and 'ply' in columns:
                     self.ply_info['count'] = count
-                    res['ply'] = self.patch_ply_header.format(**self.ply_info) + self.patch_data
+                    res['ply'] = self.patch_ply_header.format(**self.ply_info) + \
+                        self.patch_data.view().tostring()
                 yield res
 
+    def get_rel_size(self, quals, columns):
+        """
+        Estimate the number of rows and their width for the planner, from
+        the message counts and time ranges of the bags inside the time quals
+        """
+        if self.pointcloud_formats is not None:
+            return max(len(self.pointcloud_formats), 1), max([
+                len(f['schema'] or '') + len(f['ply_header'] or '')
+                for f in self.pointcloud_formats] or [1])
+        bounds = get_bounds(quals, 'time')
+        times = get_values(quals, 'time')
+        messages = 0.
+        for bag_catalog in self.catalogs:
+            topics = bag_catalog.topics()
+            time_range = bag_catalog.time_range()
+            if self.topic in topics and time_range is not None:
+                messages += topics[self.topic].message_count * \
+                    bounded_fraction(time_range[0], time_range[1], bounds)
+        if times is not None:
+            messages = min(messages, len(times))
+
+        pointcloud2 = self.infos.msg_type == 'sensor_msgs/PointCloud2'
+        if pointcloud2:
+            points = self.patch_count_pointcloud or self.message_points
+            # a row per message when the first message is empty
+            rows = messages * self.message_points / points if self.message_points else messages
+        elif self.patch_column in columns:
+            points = self.patch_count_default
+            # the last point of a patch is repeated in the next one
+            rows = messages / max(points - 1, 1)
+        else:
+            points, rows = 0, messages
+        point_size, ndims = 0, 0
+        if self.patch_schema:
+            dtype = schema_dtype(self.patch_schema)
+            point_size = dtype.itemsize
+            if self.compression != 'none':
+                ndims = len(dtype.names)
+        width = 0
+        for column in columns:
+            if column == self.patch_column:
+                width += patch_width(points, point_size, self.output, ndims)
+            elif column == 'ply' and self.patch_ply_header:
+                width += len(self.patch_ply_header) + points * point_size
+            else:
+                width += 8
+        return max(int(rows), 1), width
+
+    def get_path_keys(self):
+        """
+        A time selects the rows of a message: the patches of a point cloud,
+        a single row otherwise
+        """
+        if self.pointcloud_formats is not None:
+            return []
+        rows = 1
+        if self.infos.msg_type == 'sensor_msgs/PointCloud2' and self.patch_count_pointcloud:
+            rows = max(self.message_points // self.patch_count_pointcloud, 1)
+        return [(('time', ), rows)]
+
+    def read_messages(self, scans, raw):
+        """
+        Yield the (filename, topic, message, time) of the messages of the
+        scans merged in time order, point clouds read serialized being parsed
+        """
+        for _, filename, topic, msg, t in merge_scans(scans):
+            if raw:
+                msg = parse_pointcloud2(msg[1])
+            yield filename, topic, msg, t
+
+    def read_bag(self, bag_catalog, tmin, tmax, raw):
+        """
+        Yield the (time, filename, topic, message, time) of the messages of
+        a bag, which is closed when exhausted if the table has several bags
+        """
+        try:
+            for topic, msg, t in bag_catalog.get_bag().read_messages(
+                    topics=self.topic, start_time=tmin, end_time=tmax, raw=raw):
+                yield t.to_nsec(), bag_catalog.path, topic, msg, t
+        finally:
+            if len(self.catalogs) > 1:
+                bag_catalog.close()
+
+    def read_bag_reversed(self, bag_catalog, time_range, tmin, tmax, raw):
+        """
+        Yield the (negated time, filename, topic, message, time) of the
+        messages of a bag in reverse time order: the bag is read by time
+        windows from its end, whose duration is estimated from the message
+        rate of the topic, and the messages of each window are reversed.
+        """
+        from rospy.rostime import Time
+        lower, upper = time_range
+        if tmin is not None:
+            lower = max(lower, tmin.to_nsec())
+        if tmax is not None:
+            upper = min(upper, tmax.to_nsec())
+        count = max(bag_catalog.topics()[self.topic].message_count, 1)
+        period = max((time_range[1] - time_range[0]) // count, 1)
+        window = REVERSE_WINDOW
+        window_max = REVERSE_WINDOW_MAX
+        if self.infos.msg_type == 'sensor_msgs/PointCloud2':
+            window_max = REVERSE_WINDOW_MAX_POINTCLOUD
+        try:
+            while upper >= lower:
+                start = max(upper - window * period, lower)
+                messages = list(bag_catalog.get_bag().read_messages(
+                    topics=self.topic, raw=raw,
+                    start_time=Time(start // 1000000000, start % 1000000000),
+                    end_time=Time(upper // 1000000000, upper % 1000000000)))
+                for topic, msg, t in reversed(messages):
+                    yield -t.to_nsec(), bag_catalog.path, topic, msg, t
+                upper = start - 1
+                window = min(window * 2, window_max)
+        finally:
+            if len(self.catalogs) > 1:
+                bag_catalog.close()
+
+    def make_patch(self, count, data):
+        """
+        Build a patch from the packed data (bytes or uint8 array) of count
+        points, uncompressed or with dimensional compression depending on
+        the compression option
+        """
+        if self.compression == 'none':
+            return point_patch(self.pcid, count, [data], self.endianness)
+        byteorder = '<' if self.endianness else '>'
+        if byteorder not in self.patch_dtypes:
+            self.patch_dtypes[byteorder] = schema_dtype(self.patch_schema, byteorder)
+        dtype = self.patch_dtypes[byteorder]
+        points = np.frombuffer(data, dtype=dtype)
+        return dimensional_patch(
+            self.pcid, [points[name] for name in dtype.names], self.compression)
+
+    def compile_plan(self, msg, columns):
+        """
+        Compile, from the first message of a scan, how columns are read from
+        messages: a getter and a converter for each column, and the struct
+        packing points of non PointCloud2 topics
+        """
+        data_columns = set(columns)
+        if self.patch_column in columns:
+            data_columns = data_columns.union(self.patch_columns) - set([self.patch_column])
+        self.with_filename = "filename" in data_columns
+        self.with_topic = "topic" in data_columns
+        self.with_time = "time" in data_columns
+        data_columns = data_columns - set(["filename", "topic", "time"])
+        pointcloud2 = self.infos.msg_type == 'sensor_msgs/PointCloud2'
+        if pointcloud2:
+            data_columns = data_columns - set(['ply', self.patch_column])
+
+        self.accessors = []
+        for column in data_columns:
+            getter, attr = compile_getter(msg, column)
+            fmt = self.columns[column][3] if column in self.columns else None
+            self.accessors.append((column, getter, compile_converter(attr, fmt)))
+
+        self.filters = []
+        for qual in self.filter_quals:
+            check = compile_qual(qual)
+            if check is not None:
+                getter, attr = compile_getter(msg, qual.field_name)
+                self.filters.append((getter, compile_converter(attr, None), check))
+
+        self.point_dtypes = None
+        if pointcloud2 and self.fields:
+            self.point_dtypes = pointcloud_dtype(msg, self.fields)
+        self.point_filter = None
+        if pointcloud2 and (self.voxel_size or self.range_min or self.range_max or
+                            self.drop_nan):
+            names = [field.name for field in msg.fields]
+            if not set(['x', 'y', 'z']).issubset(names):
+                log_to_postgres(
+                    'points of {} have no x, y and z fields'.format(self.topic), ERROR,
+                    hint='voxel_size, range_min, range_max and drop_nan filter points '
+                    'on their coordinates')
+            self.point_filter = partial(
+                filter_points, voxel_size=self.voxel_size, range_min=self.range_min,
+                range_max=self.range_max, drop_nan=self.drop_nan)
+            self.point_record = np.dtype((np.void, msg.point_step))
+            self.point_xyz, _ = pointcloud_dtype(msg, ['x', 'y', 'z'])
+
+        self.point_struct = None
+        if self.patch_column in columns and not pointcloud2:
+            self.point_struct = Struct(self.columns[self.patch_column][3])
+            self.patch_count = self.patch_count_default
+            self.point_size = self.point_struct.size
+            self.patch_size = self.patch_count * self.point_size
+            self.patch_step_size = self.patch_size - self.point_size
+
     def get_rows(self, topic, msg, t, columns, toplevel=True):
         if toplevel and len(msg.__slots__) == 1:
             attr = getattr(msg, msg.__slots__[0])
@@ -381,65 +1149,66 @@ class Rosbag(ForeignDataWrapper):
                     for row in self.get_rows(topic, msg, t, columns, False):
                         yield row
                 return
+        if self.accessors is None:
+            self.compile_plan(msg, columns)
+        for getter, convert, check in self.filters:
+            attr = getter(msg)
+            if not check(convert(attr) if convert else attr):
+                return
         res = {}
-        data_columns = set(columns)
-        if self.patch_column in columns:
-            data_columns = data_columns.union(self.patch_columns) - set([self.patch_column])
-        if "filename" in data_columns:
+        if self.with_filename:
             res["filename"] = self.filename
-        if "topic" in data_columns:
+        if self.with_topic:
             res["topic"] = topic
-        if "time" in data_columns:
+        if self.with_time:
             res["time"] = t.to_nsec()
         if self.infos.msg_type == 'sensor_msgs/PointCloud2':
-            self.patch_count = self.patch_count_pointcloud or (msg.width*msg.height)
-            self.point_size = msg.point_step
+            npoints = msg.width * msg.height
+            data = msg.data
+            if self.point_filter:
+                # points are filtered as whole records, before packing
+                records = np.frombuffer(data, dtype=self.point_record,
+                                        count=len(data) // msg.point_step)
+                records = records[self.point_filter(records.view(self.point_xyz))]
+                if not len(records):
+                    return
+                npoints, data = len(records), records.view('u1')
+            self.patch_count = self.patch_count_pointcloud or npoints
+            self.endianness = 0 if msg.is_bigendian else 1
+            if self.point_dtypes:
+                # selected fields are packed without padding
+                view, packed = self.point_dtypes
+                points = np.frombuffer(data, dtype=view,
+                                       count=len(data) // msg.point_step)
+                data = np.empty(len(points), dtype=packed)
+                for name in packed.names:
+                    data[name] = points[name]
+                self.point_size = packed.itemsize
+                self.patch_data.append(data.view('u1'))
+            else:
+                self.point_size = msg.point_step
+                self.patch_data.append(data)
             self.patch_size = self.patch_count * self.point_size
             self.patch_step_size = self.patch_size
-            self.endianness = 0 if msg.is_bigendian else 1
-            data_columns = data_columns - set(['ply', self.patch_column])
-            self.patch_data += msg.data
 
-        data_columns = data_columns - set(res.keys())
-        for column in data_columns:
-            attr = msg
-            for col in column.split('.'):
-                if isinstance(attr, list):
-                    attr = tuple(getattr(a, col) for a in attr)
-                else:
-                    attr = getattr(attr, col)
-            if hasattr(attr, "to_nsec"):
-                attr = attr.to_nsec()
-            elif hasattr(attr, "x"):
-                if hasattr(attr, "w"):
-                    attr = (attr.x, attr.y, attr.z, attr.w)
-                else:
-                    attr = (attr.x, attr.y, attr.z)
-            elif isinstance(attr, str):
-                fmt = self.columns[column][3]
-                if fmt:
-                    attr = unpack(fmt, attr)
-            res[column] = attr
-
-        if self.patch_column in columns and not self.infos.msg_type == 'sensor_msgs/PointCloud2':
-            fmt = self.columns[self.patch_column][3]
-            self.patch_count = self.patch_count_default
-            self.point_size = calcsize(fmt)
-            self.patch_size = self.patch_count * self.point_size
-            self.patch_step_size = self.patch_size - self.point_size
-            self.patch_data += get_point_data(res, self.patch_columns, fmt)
+        for column, getter, convert in self.accessors:
+            attr = getter(msg)
+            res[column] = convert(attr) if convert else attr
+
+        if self.point_struct:
+            self.patch_data.append(
+                get_point_data(res, self.patch_columns, self.point_struct))
             res = {k: v for k, v in res.items() if k not in self.patch_columns}
 
-        if not self.patch_data:
+        if not len(self.patch_data):
             yield res
         else:
             # todo: ensure current res and previous res are equal if there is some leftover
             # patch_data
-            while len(self.patch_data) >= self.patch_size:
-                data = self.patch_data[0:self.patch_size]
+            for data in self.patch_data.patches(self.patch_size, self.patch_step_size):
                 count = int(self.patch_size / self.point_size)
-                res[self.patch_column] = hexlify(
-                        pack('=b3I', self.endianness, self.pcid, 0, count) + data)
+                res[self.patch_column] = format_patch(
+                    self.make_patch(count, data), self.output)
                 if self.patch_ply_header and 'ply' in columns:
                     self.ply_info = {
                         'endianness': 'big' if self.endianness else 'little',
@@ -447,7 +1216,7 @@ class Rosbag(ForeignDataWrapper):
                         'topic': self.topic,
                         'count': count
                     }
-                    res['ply'] = self.patch_ply_header.format(**self.ply_info) + data
-                self.patch_data = self.patch_data[self.patch_step_size:]
+                    res['ply'] = self.patch_ply_header.format(**self.ply_info) + \
+                        data.tostring()
                 yield res
             self.last_row = res
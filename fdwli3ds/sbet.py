@@ -1,16 +1,185 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import re
+import json
 import math
 from glob import glob
-from struct import pack
-from binascii import hexlify
 
 import numpy as np
-from multicorn.utils import log_to_postgres
+from multicorn.utils import log_to_postgres, ERROR, WARNING
 
 from .foreignpc import ForeignPcBase
-from .util import strtobool
+from .pcpatch import dimensional_patch, point_patch, format_patch, patch_width
+from .projection import projection
+from .util import (strtobool, get_bounds, get_values, time_slice, overlaps,
+                   bounded_fraction, save_json)
+
+# number of records converted at once
+CHUNK_SIZE = 1 << 20
+
+# scale of projected coordinates in patches (meters)
+PROJECTED_SCALE = '0.01'
+
+# attitude angles (radians), interpolated along the shortest arc
+ANGLES = ('m_roll', 'm_pitch', 'm_plateformHeading', 'm_wanderAngle')
+
+
+def interpolate_poses(sbet, times, names, time_offset=0):
+    """
+    Interpolate the records of sbet (ordered by m_time) at times, which
+    must lie between the first and last m_time (shifted by time_offset).
+    Values are interpolated linearly, angles along the shortest arc from
+    the record before (without changing their range), and the values of a
+    record are returned as is at its time.
+    Returns a dict of arrays, one for each name
+    """
+    # records before and after each time, found by binary search
+    after = np.searchsorted(sbet['m_time'], times - time_offset, side='right')
+    after = np.minimum(np.maximum(after, 1), len(sbet) - 1)
+    before = np.maximum(after - 1, 0)
+    before, after = sbet[before], sbet[after]
+    time_before = before['m_time'] + time_offset
+    time_after = after['m_time'] + time_offset
+    delta = time_after - time_before
+    weight = np.where(
+        delta > 0, (times - time_before) / np.where(delta > 0, delta, 1), 0)
+    poses = {}
+    for name in names:
+        diff = after[name] - before[name]
+        if name in ANGLES:
+            diff = (diff + np.pi) % (2 * np.pi) - np.pi
+        values = before[name] + weight * diff
+        values = np.where(times == time_after, after[name], values)
+        poses[name] = np.where(times == time_before, before[name], values)
+    return poses
+
+
+def simplify_trajectory(m_time, x, y, z, tolerance):
+    """
+    Shape-preserving simplification of a trajectory (x and y in radians, z in
+    meters), a Douglas-Peucker using the distance between each record and its
+    position interpolated in time between the kept records of its segment.
+    All the segments are split at once at each iteration.
+    Returns the mask of kept records (the first and last ones included)
+    """
+    # local metric coordinates
+    earth_radius = 6378137.
+    coords = np.vstack((x * earth_radius * np.cos(y), y * earth_radius, z))
+    keep = np.zeros(len(m_time), dtype='bool')
+    keep[[0, -1]] = True
+    while True:
+        kept = np.flatnonzero(keep)
+        # segment of each record, between two kept records
+        segment = np.minimum(
+            np.searchsorted(kept, np.arange(len(m_time)), side='right') - 1,
+            len(kept) - 2)
+        first, last = kept[segment], kept[segment + 1]
+        delta = m_time[last] - m_time[first]
+        weight = np.where(
+            delta > 0, (m_time - m_time[first]) / np.where(delta > 0, delta, 1), 0)
+        interpolated = coords[:, first] + weight * (coords[:, last] - coords[:, first])
+        distance = ((coords - interpolated) ** 2).sum(axis=0)
+        distance[keep] = 0
+        # farthest record of each segment, split if above the tolerance
+        farthest = np.maximum.reduceat(distance, kept[:-1])
+        split = (distance == farthest[segment]) & (distance > tolerance ** 2)
+        if not split.any():
+            return keep
+        # only the first farthest record of a segment is kept
+        _, first_split = np.unique(segment[split], return_index=True)
+        keep[np.flatnonzero(split)[first_split]] = True
+
+
+class SbetCatalog(object):
+    """
+    Catalog of sbet files.
+
+    For each file, it records the number of records, the first and last
+    m_time (records are ordered by time) and the extent of the trajectory
+    (longitude and latitude in degrees, height in meters). The catalog is
+    cached in a json file, an entry is reused as long as the size and the
+    modification time of its file are unchanged. Tables can share a catalog,
+    entries of other sources are kept as long as their file exists.
+    """
+    version = 1
+
+    def __init__(self, filename, source_type):
+        self.filename = filename
+        self.source_type = source_type
+        self.entries = None
+
+    def load(self, sources):
+        """
+        Read the cached catalog, indexing new or modified files. Sources are
+        checked on every call, the table may be scanned again after a file
+        changed. Returns the entries of sources, in the same order.
+        """
+        stats = [os.stat(source) for source in sources]
+        if self.entries is not None and all(
+                entry['path'] == source and entry['size'] == stat.st_size and
+                entry['mtime'] == stat.st_mtime
+                for entry, source, stat in zip(self.entries, sources, stats)):
+            return self.entries
+        cached = {}
+        try:
+            with open(self.filename) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            pass
+        if cached.get('version') != self.version:
+            cached = {}
+        previous = cached.get('files', {})
+
+        # entries of other tables sharing the catalog are kept, as long as
+        # their file exists
+        files = dict(
+            (path, entry) for path, entry in previous.items()
+            if path in sources or os.path.exists(path))
+        self.entries = []
+        for source, stat in zip(sources, stats):
+            entry = previous.get(source)
+            if entry is None or entry['size'] != stat.st_size or \
+               entry['mtime'] != stat.st_mtime:
+                entry = self.index_file(source, stat.st_size, stat.st_mtime)
+            files[source] = entry
+            self.entries.append(entry)
+
+        if files != previous:
+            self.save({'version': self.version, 'files': files})
+        return self.entries
+
+    def save(self, content):
+        try:
+            save_json(self.filename, content)
+        except (IOError, OSError) as e:
+            log_to_postgres(
+                'sbet catalog could not be saved: {}'.format(e), WARNING,
+                hint='use the catalog option to choose a writable location')
+
+    def index_file(self, path, size, mtime):
+        entry = {
+            'path': path,
+            'size': size,
+            'mtime': mtime,
+            'records': size // np.dtype(self.source_type).itemsize,
+        }
+        if not entry['records']:
+            return entry
+        sbet = np.memmap(path, dtype=self.source_type, mode='r',
+                         shape=(entry['records'], ))
+        entry['tmin'] = float(sbet['m_time'][0])
+        entry['tmax'] = float(sbet['m_time'][-1])
+        lower, upper = [], []
+        for start in range(0, len(sbet), CHUNK_SIZE):
+            chunk = sbet[start:start + CHUNK_SIZE]
+            lower.append([chunk[name].min() for name in ('x', 'y', 'z')])
+            upper.append([chunk[name].max() for name in ('x', 'y', 'z')])
+        lower, upper = np.min(lower, axis=0), np.max(upper, axis=0)
+        # x and y are stored in radians
+        lower[:2], upper[:2] = np.degrees(lower[:2]), np.degrees(upper[:2])
+        entry['extent'] = [float(value) for value in np.r_[lower, upper]]
+        return entry
 
 
 class Sbet(ForeignPcBase):
@@ -24,6 +193,24 @@ class Sbet(ForeignPcBase):
 
         - sources: file glob pattern for source files (ex: *.sbet)
         - patch_size: how many points sewing in a patch
+        - compression: none (default, uncompressed patches), rle, sigbits,
+          zlib or auto (dimensional patches, see pcpatch)
+        - catalog: path of the catalog of source files (default is
+          .sbet_catalog.json in the directory of the sources)
+        - bbox: xmin, ymin, xmax, ymax in degrees, sources whose
+          trajectory is outside are skipped
+        - poses: true to return one row per pose instead of patches (see
+          read_poses)
+        - decimate: only keep one record every n records ('200'), or the
+          first record of each time step ('1s')
+        - simplify: tolerance in meters of a shape-preserving simplification
+          of the trajectory (after decimation)
+        - target_srid: project x and y to a metric coordinate system (UTM
+          zones, Lambert-93 or the conic conformal zones, see projection)
+
+    An optional time column holds the time of the first point of each patch
+    (the point repeated by the overlap option excepted), quals on it are
+    pushed down.
     """  # NOQA
 
     def __init__(self, options, columns):
@@ -34,14 +221,64 @@ class Sbet(ForeignPcBase):
                 os.path.realpath(source) for source in glob(options['sources'])
             ]
             log_to_postgres('{} sbet file(s) linked'.format(len(self.sources)))
+        self.bbox = None
+        if 'bbox' in options:
+            try:
+                self.bbox = [float(value) for value in options['bbox'].split(',')]
+            except ValueError:
+                self.bbox = []
+            if len(self.bbox) != 4:
+                log_to_postgres(
+                    'invalid bbox: {}'.format(options['bbox']), ERROR,
+                    hint='bbox is xmin, ymin, xmax, ymax in degrees')
         # set default patch size to 100 points if not given
         self.patch_size = int(options.get('patch_size', 100))
+        # projection of x and y, the schema is changed accordingly
+        self.target_srid = None
+        self.projection = None
+        if 'target_srid' in options:
+            self.target_srid = int(options['target_srid'])
+            self.projection = projection(self.target_srid)
+            if self.projection is None:
+                log_to_postgres(
+                    'unsupported target_srid: {}'.format(self.target_srid),
+                    ERROR,
+                    hint='supported srids are UTM zones (326xx, 327xx, 258xx), '
+                         'Lambert-93 (2154) and CC42 to CC50 (3942 to 3950)')
         # sbet schema is provided
         self.pcschema = os.path.join(os.path.dirname(__file__),
                                      'schemas', 'sbetschema.xml')
+        if 'sources' in options:
+            # first/last times and extents of sources, cached in a file
+            default_catalog = os.path.join(
+                os.path.dirname(os.path.commonprefix(self.sources)),
+                '.sbet_catalog.json')
+            self.catalog = SbetCatalog(
+                options.get('catalog', default_catalog), self.source_type())
         # add overlap option (which add the previous point in each patch and build
         # a continuous timeline for trajectories)
         self.overlap = strtobool(options.get('overlap', 'True'))
+        # one row per pose, with a column per dimension
+        self.poses = strtobool(options.get('poses', 'false'))
+        # overview of the trajectory: decimation by stride or time step,
+        # and simplification
+        self.stride, self.time_step = None, None
+        decimate = options.get('decimate', '').strip()
+        try:
+            if decimate.endswith('s'):
+                self.time_step = float(decimate[:-1])
+            elif decimate:
+                self.stride = int(decimate)
+        except ValueError:
+            pass
+        if decimate and not (self.stride or self.time_step or 0) > 0:
+            log_to_postgres(
+                'invalid decimate: {}'.format(decimate), ERROR,
+                hint='decimate is a number of records (200) or a time step '
+                     'in seconds (1s)')
+        self.simplify = float(options.get('simplify', 0))
+        # records kept in each source by decimation and simplification
+        self.decimated = {}
 
     def execute(self, quals, columns):
         # When the metadata parameter has been passed to the foreign table
@@ -52,11 +289,81 @@ class Sbet(ForeignPcBase):
             yield {'schema': self.read_pcschema()}
             return
 
-        for source in self.sources:
-            for patch in self.read_sbet(source):
-                yield patch
+        if self.poses:
+            for row in self.read_poses(quals, columns):
+                yield row
+            return
+
+        bounds = get_bounds(quals, 'time')
+        for entry in self.catalog.load(self.sources):
+            if self.source_may_match(entry, bounds):
+                for patch in self.read_sbet(entry['path'], bounds, columns):
+                    yield patch
+
+    def get_rel_size(self, quals, columns):
+        """
+        Estimate the number of rows and their width for the planner, from
+        the records of the catalog entries inside the time quals (decimation
+        is accounted for, simplification and compression are not)
+        """
+        if self.metadata:
+            return 1, len(self.read_pcschema())
+        bounds = get_bounds(quals, 'time')
+        times = get_values(quals, 'time')
+        records = 0.
+        for entry in self.catalog.load(self.sources):
+            if not self.source_may_match(entry, bounds):
+                continue
+            fraction = bounded_fraction(entry['tmin'] + self.time_offset,
+                                        entry['tmax'] + self.time_offset, bounds)
+            kept = entry['records'] * fraction
+            if self.stride:
+                kept /= self.stride
+            elif self.time_step:
+                kept = min(kept, (entry['tmax'] - entry['tmin']) * fraction /
+                           self.time_step + 1)
+            records += kept
+
+        if self.poses:
+            rows = len(times) if times is not None else records
+            return max(int(rows), 1), 8 * len(columns or self.dimensions)
+        rows = math.ceil(records / self.patch_size)
+        if times is not None:
+            # a time selects the patch starting at this time
+            rows = min(rows, len(times))
+        point_size = sum(int(dim.size) for dim in self.dimensions)
+        ndims = len(self.dimensions) if self.compression != 'none' else 0
+        width = patch_width(self.patch_size + int(self.overlap), point_size,
+                            self.output, ndims)
+        if columns and 'time' in columns:
+            width += 8
+        return max(int(rows), 1), width
+
+    def get_path_keys(self):
+        """
+        A time selects a single patch (starting at this time) or pose
+        """
+        if self.metadata:
+            return []
+        return [(('time', ), 1)]
 
-    def read_sbet(self, sbetfile):
+    def source_may_match(self, entry, bounds):
+        """
+        Checks from its catalog entry if a source may have records inside
+        the time bounds and the bbox option
+        """
+        if not entry['records']:
+            return False
+        if not overlaps(entry['tmin'] + self.time_offset,
+                        entry['tmax'] + self.time_offset, bounds):
+            return False
+        if self.bbox:
+            xmin, ymin, _, xmax, ymax, _ = entry['extent']
+            return (xmin <= self.bbox[2] and self.bbox[0] <= xmax and
+                    ymin <= self.bbox[3] and self.bbox[1] <= ymax)
+        return True
+
+    def read_sbet(self, sbetfile, bounds=(None, None), columns=None):
         """
         Read a sbet file and yield patches.
 
@@ -69,64 +376,227 @@ class Sbet(ForeignPcBase):
             uint32:       npoints
             pointdata[]:  interpret relative to pcid
             header = pack('<b3I', 1, pcid, 0, patch_size)
+
+        Patches are hex encoded, or raw bytes with the output option set
+        to bytea.
+
+        Records are cut every patch_size records from the start of the file.
+        Only the records inside the time bounds are read, found by binary
+        search on the (monotonic) time column, so the first and last patches
+        are truncated but other patches are identical to a full scan.
+        With the decimate and simplify options, only the kept records are
+        read and cut in patches.
         """
 
-        # get scaling factors for x, y, z coordinates
-        scale_x = float([
-            dim.scale for dim in self.dimensions
-            if dim.name.lower() == 'x'][0])
-        scale_y = float([
-            dim.scale for dim in self.dimensions
-            if dim.name.lower() == 'y'][0])
-        scale_z = float([
-            dim.scale for dim in self.dimensions
-            if dim.name.lower() == 'z'][0])
-
-        # apply conversion from radian to degrees for x, y only
-        rad2deg_scaled_x = 180 / math.pi / scale_x
-        rad2deg_scaled_y = 180 / math.pi / scale_y
-
-        # store numpy structured types
-        sbet_source_type = [(dim.name, 'double') for dim in self.dimensions]
-        sbet_patch_type = [(dim.name, dim.type) for dim in self.dimensions]
-
-        # open file as a memory map in Copy-on-write mode
-        # (assignments affect data in memory, but changes are not saved to
-        # disk. The file on disk is read-only)
-        sbet = np.memmap(str(sbetfile), dtype=sbet_source_type, mode='c')
-        sbet_size = len(sbet)
-        # constructs slices according to patch_size
-        slices = [
-            slice(a, b)
-            for a, b in zip(
-                range(0, sbet_size, self.patch_size),
-                range(self.patch_size, sbet_size, self.patch_size)
-            )
+        # open file as a read-only memory map, records are only read
+        # when converted
+        sbet = np.memmap(str(sbetfile), dtype=self.source_type(), mode='r')
+        # records inside the time bounds
+        selected = time_slice(sbet['m_time'], bounds, self.time_offset)
+        kept = self.kept_records(sbetfile, sbet)
+        if kept is not None:
+            # the selection is then a range of kept records
+            selected = slice(*np.searchsorted(
+                kept, [selected.start, selected.stop]).tolist())
+        if selected.start == selected.stop:
+            return
+
+        # records are converted by chunks of whole patches in a buffer of the
+        # patch type, patches are views of this buffer
+        chunk_windows = max(CHUNK_SIZE // self.patch_size, 1)
+        buffer = None
+
+        windows = range(selected.start // self.patch_size,
+                        (selected.stop - 1) // self.patch_size + 1)
+        for chunk_idx in range(0, len(windows), chunk_windows):
+            chunk = windows[chunk_idx:chunk_idx + chunk_windows]
+            # overlap option: repeat the previous record in each patch
+            # (but the first one of the file)
+            base = max(chunk[0] * self.patch_size, selected.start)
+            if self.overlap and base > 0:
+                base -= 1
+            end = min((chunk[-1] + 1) * self.patch_size, selected.stop)
+            if buffer is None or len(buffer) < end - base:
+                buffer = np.empty(end - base, dtype=self.patch_type())
+            records = sbet[base:end] if kept is None else sbet[kept[base:end]]
+            self.convert(records, buffer[:end - base])
+
+            for window_idx in chunk:
+                start = max(window_idx * self.patch_size, selected.start)
+                stop = min((window_idx + 1) * self.patch_size, selected.stop)
+                first = start - 1 if self.overlap and start > 0 else start
+                points = buffer[first - base:stop - base]
+
+                if self.compression != 'none':
+                    # dimensional patch, built from each field of the points
+                    patch = dimensional_patch(
+                        self.pcid,
+                        [points[dim.name] for dim in self.dimensions],
+                        self.compression)
+                else:
+                    patch = point_patch(self.pcid, stop - first, [points])
+                row = {'points': format_patch(patch, self.output)}
+                if columns and 'time' in columns:
+                    row['time'] = float(buffer['m_time'][start - base])
+                yield row
+
+    def kept_records(self, sbetfile, sbet):
+        """
+        Returns the index of the records kept by the decimate and simplify
+        options, or None to keep all records. It is computed on the whole
+        file, so that patches do not depend on time quals, and cached until
+        the file changes.
+        """
+        if not (self.stride or self.time_step or self.simplify):
+            return None
+        stat = os.stat(sbetfile)
+        key = (stat.st_size, stat.st_mtime)
+        if self.decimated.get(sbetfile, (None, ))[0] == key:
+            return self.decimated[sbetfile][1]
+
+        if self.time_step:
+            # first record of each time step
+            steps = np.floor((sbet['m_time'] + self.time_offset) / self.time_step)
+            kept = np.flatnonzero(np.r_[True, steps[1:] != steps[:-1]])
+        else:
+            kept = np.arange(0, len(sbet), self.stride or 1)
+        if self.simplify and len(kept) > 2:
+            records = sbet[kept]
+            kept = kept[simplify_trajectory(
+                records['m_time'], records['x'], records['y'], records['z'],
+                self.simplify)]
+        self.decimated[sbetfile] = (key, kept)
+        return kept
+
+    def read_poses(self, quals, columns=None):
+        """
+        Yield poses as rows with a time column and a column for each
+        dimension (x and y in degrees or projected, z in meters, angles in
+        radians).
+
+        With time = value or time = ANY(array) quals, poses are interpolated
+        at the requested times, using a binary search on the time of the
+        memory-mapped sources: lidar points can be georeferenced without
+        joining trajectory patches. Times outside the sources are ignored.
+        Otherwise, the records inside the time bounds are returned.
+        """
+        names = [
+            dim.name for dim in self.dimensions
+            if columns is None or dim.name in columns or
+            # both coordinates are needed by the projection
+            (self.projection and dim.name in ('x', 'y'))
         ]
-        if slices[-1].stop != sbet_size:
-            # append the end of the array
-            slices.append(slice(slices[-1].stop, sbet_size))
-
-        last_one = None
-
-        for idx, sli in enumerate(slices):
-
-            subarray = sbet[sli]
-            # convert to degrees and apply scale factor
-            subarray['x'] = rad2deg_scaled_x * subarray['x']
-            subarray['y'] = rad2deg_scaled_y * subarray['y']
-            subarray['z'] = subarray['z'] / scale_z
-            subarray['m_time'] += self.time_offset
-            # cast to pointcloud xml schema types
-            subarray = subarray.astype(sbet_patch_type)
-
-            if idx > 0 and self.overlap:
-                header = pack('<b3I', 1, self.pcid, 0, sli.stop - sli.start + 1)
-                data = hexlify(header + last_one.tostring() + subarray.tostring())
-                # overlap option: repeat the last values from the previous patch
-                last_one = subarray[-1]
-                yield {'points': data}
+        bounds = get_bounds(quals, 'time')
+        times = get_values(quals, 'time')
+        if times is not None:
+            times = np.array(
+                [time for time in times if overlaps(time, time, bounds)],
+                dtype='float64')
+
+        for entry in self.catalog.load(self.sources):
+            if not self.source_may_match(entry, bounds):
+                continue
+            sbet = np.memmap(entry['path'], dtype=self.source_type(), mode='r')
+            if times is None:
+                selected = time_slice(sbet['m_time'], bounds, self.time_offset)
+                for start in range(selected.start, selected.stop, CHUNK_SIZE):
+                    records = sbet[start:min(start + CHUNK_SIZE, selected.stop)]
+                    poses = {name: records[name] for name in names}
+                    poses['time'] = records['m_time'] + self.time_offset
+                    for row in self.pose_rows(poses, columns):
+                        yield row
+                continue
+            inside = ((times >= entry['tmin'] + self.time_offset) &
+                      (times <= entry['tmax'] + self.time_offset))
+            if not inside.any():
+                continue
+            poses = interpolate_poses(
+                sbet, times[inside], names, self.time_offset)
+            poses['time'] = times[inside]
+            for row in self.pose_rows(poses, columns):
+                yield row
+            # a time is only returned once, even if sources overlap
+            times = times[~inside]
+
+    def pose_rows(self, poses, columns=None):
+        """
+        Convert arrays of poses to rows
+        """
+        if self.projection:
+            poses['x'], poses['y'] = self.projection(poses['x'], poses['y'])
+        if 'x' in poses and not self.projection:
+            poses['x'] = np.degrees(poses['x'])
+        if 'y' in poses and not self.projection:
+            poses['y'] = np.degrees(poses['y'])
+        if 'm_time' in poses:
+            poses['m_time'] = poses['m_time'] + self.time_offset
+        names = [
+            name for name in poses if columns is None or name in columns]
+        for values in zip(*[poses[name].tolist() for name in names]):
+            yield dict(zip(names, values))
+
+    def read_pcschema(self):
+        """
+        Read the sbet pointcloud schema. With the target_srid option,
+        x and y are projected coordinates with a metric scale
+        """
+        content = super(Sbet, self).read_pcschema()
+        if self.projection is None:
+            return content
+        for name, axis in (('x', 'easting'), ('y', 'northing')):
+            content = re.sub(
+                r'(<pc:name>{}</pc:name>\s*<pc:description>)[^<]*'
+                r'(</pc:description>.*?<pc:scale>)[^<]*(</pc:scale>)'.format(name),
+                r'\g<1>{} in meters (EPSG:{})\g<2>{}\g<3>'.format(
+                    axis, self.target_srid, PROJECTED_SCALE),
+                content, count=1, flags=re.DOTALL)
+        return content
+
+    def source_type(self):
+        """
+        numpy structured type of sbet records (only doubles)
+        """
+        return [(dim.name, 'double') for dim in self.dimensions]
+
+    def patch_type(self):
+        """
+        numpy structured type of the points, according to the pointcloud
+        xml schema
+        """
+        return [(dim.name, dim.type) for dim in self.dimensions]
+
+    def convert(self, records, points):
+        """
+        Convert sbet records to points of the patch type, in place in the
+        points array: x and y are converted from radians to degrees (or
+        projected with the target_srid option), then x, y and z are scaled
+        and the time offset is applied to m_time.
+        """
+        # get scaling factors for x, y, z coordinates
+        scales = {
+            dim.name.lower(): float(dim.scale)
+            for dim in self.dimensions if dim.name.lower() in ('x', 'y', 'z')
+        }
+        factors = {
+            # apply conversion from radian to degrees for x, y only
+            'x': 180 / math.pi / scales['x'],
+            'y': 180 / math.pi / scales['y'],
+        }
+        if self.projection:
+            projected = dict(zip(
+                ('x', 'y'), self.projection(records['x'], records['y'])))
+        for dim in self.dimensions:
+            if self.projection and dim.name in projected:
+                np.divide(projected[dim.name], scales[dim.name],
+                          out=points[dim.name], casting='unsafe')
+            elif dim.name in factors:
+                np.multiply(factors[dim.name], records[dim.name],
+                            out=points[dim.name], casting='unsafe')
+            elif dim.name == 'z':
+                np.divide(records['z'], scales['z'],
+                          out=points['z'], casting='unsafe')
+            elif dim.name == 'm_time':
+                np.add(records['m_time'], self.time_offset,
+                       out=points['m_time'], casting='unsafe')
             else:
-                header = pack('<b3I', 1, self.pcid, 0, sli.stop - sli.start)
-                last_one = subarray[-1]
-                yield {'points': hexlify(header + subarray.tostring())}
+                points[dim.name] = records[dim.name]
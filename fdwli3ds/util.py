@@ -1,7 +1,17 @@
+import os
+import json
+import signal
 import struct
+from collections import deque
+from threading import Thread, Event
+from Queue import Queue, Full
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
+from .pcpatch import decode_dimension, interpretation_dtype
+
 
 def strtobool(v):
     return v.lower() in ('yes', 'true', 't', '1')
@@ -19,16 +29,236 @@ def extract_dimension(patch, dimensions, name, compression=None):
 
     if compression == 'dimensional':
         dim_header = 5
+        npoints = int(struct.unpack('<I', patch[9:13])[0])
         # compute the offset needed to find the dimension
         # first offset is for the patch header
         offset = 13
         for dim in dimensions:
-            # skip dimensional type on 1b
-            dimsize = int(struct.unpack('<I', patch[offset + 1: offset + 5])[0])
+            # read dimensional type on 1b and size on 4b
+            dimtype, dimsize = struct.unpack('<bI', patch[offset:offset + 5])
             if dim.name == name:
                 # dimension found!
                 break
             offset += dim_header + dimsize
-        return np.fromstring(
+        return decode_dimension(
+            dimtype,
             patch[offset + dim_header:offset + dim_header + dimsize],
-            dtype=dim.type)
+            interpretation_dtype(dim.type),
+            npoints)
+
+
+def save_json(filename, content):
+    '''
+    Atomically write content to a json file (through a temporary file in the
+    same directory), may raise IOError or OSError
+    '''
+    tmpname = '{}.{}'.format(filename, os.getpid())
+    with open(tmpname, 'w') as f:
+        json.dump(content, f)
+    os.rename(tmpname, filename)
+
+
+def get_bounds(quals, field_name='time'):
+    '''
+    Reduce the quals applied on a column to a (lower, upper) interval.
+    Each bound is either None or a (value, inclusive) tuple.
+    '''
+    lower, upper = None, None
+    for qual in quals or []:
+        if qual.field_name != field_name or isinstance(qual.operator, tuple):
+            # list operators (= ANY(...)) are not handled here
+            continue
+        if qual.value is None:
+            # IS NULL / IS NOT NULL
+            continue
+        value = float(qual.value)
+        if qual.operator in ('=', '>', '>='):
+            bound = (value, qual.operator != '>')
+            if lower is None or bound[0] > lower[0] or \
+               (bound[0] == lower[0] and not bound[1]):
+                lower = bound
+        if qual.operator in ('=', '<', '<='):
+            bound = (value, qual.operator != '<')
+            if upper is None or bound[0] < upper[0] or \
+               (bound[0] == upper[0] and not bound[1]):
+                upper = bound
+    return lower, upper
+
+
+def get_values(quals, field_name='time'):
+    '''
+    Reduce the equality quals applied on a column (= and = ANY(...)) to a
+    sorted list of values, None if there is no such qual.
+    '''
+    values = None
+    for qual in quals or []:
+        if qual.field_name != field_name:
+            continue
+        if qual.operator == '=':
+            found = [qual.value]
+        elif qual.operator == ('=', True):
+            found = qual.value
+        else:
+            continue
+        found = set(float(value) for value in found if value is not None)
+        values = found if values is None else values & found
+    return None if values is None else sorted(values)
+
+
+def time_slice(times, bounds, offset=0):
+    '''
+    Returns the slice of a sorted array of times lying inside bounds
+    (as returned by get_bounds), times being shifted by offset.
+    Only O(log n) values are read, times can be a memory-mapped column.
+    '''
+    lower, upper = bounds
+
+    def above(idx):
+        value = times[idx] + offset
+        return value > lower[0] or (lower[1] and value == lower[0])
+
+    def below(idx):
+        value = times[idx] + offset
+        return value < upper[0] or (upper[1] and value == upper[0])
+
+    start, stop = 0, len(times)
+    if lower is not None:
+        start = int(np.searchsorted(
+            times, lower[0] - offset, side='left' if lower[1] else 'right'))
+        if offset:
+            # shifting the bound instead of the times may round differently
+            while start > 0 and above(start - 1):
+                start -= 1
+            while start < len(times) and not above(start):
+                start += 1
+    if upper is not None:
+        stop = int(np.searchsorted(
+            times, upper[0] - offset, side='right' if upper[1] else 'left'))
+        if offset:
+            while stop < len(times) and below(stop):
+                stop += 1
+            while stop > 0 and not below(stop - 1):
+                stop -= 1
+    return slice(start, max(start, stop))
+
+
+def overlaps(tmin, tmax, bounds):
+    '''
+    Checks if the closed interval [tmin, tmax] may contain a value
+    inside bounds (as returned by get_bounds)
+    '''
+    lower, upper = bounds
+    if lower is not None and (tmax < lower[0] or (tmax == lower[0] and not lower[1])):
+        return False
+    if upper is not None and (tmin > upper[0] or (tmin == upper[0] and not upper[1])):
+        return False
+    return True
+
+
+def bounded_fraction(tmin, tmax, bounds):
+    '''
+    Estimate the fraction of values spread evenly over the closed interval
+    [tmin, tmax] which are inside bounds (as returned by get_bounds), used
+    to report row counts to the planner
+    '''
+    if not overlaps(tmin, tmax, bounds):
+        return 0.
+    lower, upper = bounds
+    if lower is not None:
+        tmin_inside = max(tmin, lower[0])
+    else:
+        tmin_inside = tmin
+    if upper is not None:
+        tmax_inside = min(tmax, upper[0])
+    else:
+        tmax_inside = tmax
+    if tmax <= tmin:
+        return 1.
+    return float(tmax_inside - tmin_inside) / (tmax - tmin)
+
+
+def reset_sigterm():
+    '''
+    Initializer of process workers: processes forked from a PostgreSQL
+    backend inherit its SIGTERM handler, which does not exit, so that they
+    could not be terminated
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def ordered_imap(func, iterable, workers, prefetch=None, worker_type='thread'):
+    '''
+    Apply func to each item of iterable in a pool of workers
+    ('thread' or 'process') and yield results in the order of iterable.
+    At most prefetch items are pending at the same time, which bounds
+    the memory used by results waiting to be consumed.
+    '''
+    prefetch = max(prefetch or workers, 1)
+    if worker_type == 'process':
+        pool = Pool(workers, initializer=reset_sigterm)
+    else:
+        pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) >= prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+        pool.join()
+    finally:
+        # also reached when the consumer stops early: workers possibly busy
+        # are terminated, without waiting for their pending items
+        pool.terminate()
+
+
+def read_ahead(iterable, prefetch):
+    '''
+    Iterate over iterable in a thread, at most prefetch items ahead of the
+    consumer, so that reading the next items (disk I/O, decompression)
+    overlaps with their processing. Exceptions raised by iterable are
+    raised to the consumer.
+    '''
+    items = Queue(max(prefetch, 1))
+    stop = Event()
+
+    def put(item):
+        # gives up when the consumer stopped early
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as error:
+            put((False, error))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            valid, item = items.get()
+            if not valid:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        # also reached when the consumer stops early
+        stop.set()
+        thread.join()
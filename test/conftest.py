@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The sbet file used by the tests is synthetic, it is generated in
+test/data/sbet when missing.
+"""
+import os
+
+import numpy as np
+
+SBET_FILE = os.path.join(os.path.dirname(__file__), 'data', 'sbet', 'sbet.bin')
+SBET_RECORDS = 50000
+SBET_DIMENSIONS = 17
+
+
+def generate_sbet(filename, nrecords=SBET_RECORDS):
+    """
+    Write a trajectory at 200 Hz from time 300000, going north-east from
+    (2.3, 48.8) degrees with an oscillating height and roll, and a heading
+    turning 2 degrees per second. Other dimensions are zero.
+    """
+    index = np.arange(nrecords)
+    records = np.zeros((nrecords, SBET_DIMENSIONS), dtype='<f8')
+    # time, latitude, longitude and height
+    records[:, 0] = 300000 + 0.005 * index
+    records[:, 1] = np.radians(48.8 + 1e-7 * index)
+    records[:, 2] = np.radians(2.3 + 1e-7 * index)
+    records[:, 3] = 50 + np.sin(index / 100.)
+    # roll and heading
+    records[:, 7] = np.radians(1 + np.sin(index / 500.))
+    records[:, 9] = np.radians((0.01 * index) % 360)
+    tmpname = filename + '.tmp'
+    records.tofile(tmpname)
+    os.rename(tmpname, filename)
+
+
+def pytest_sessionstart(session):
+    if not os.path.exists(SBET_FILE):
+        if not os.path.isdir(os.path.dirname(SBET_FILE)):
+            os.makedirs(os.path.dirname(SBET_FILE))
+        generate_sbet(SBET_FILE)
@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import shutil
 from binascii import unhexlify
 
+import numpy as np
 import pytest
+from multicorn import Qual
 
 from fdwli3ds import EchoPulse
-from fdwli3ds.util import extract_dimension
+from fdwli3ds.echopulse import expand_pulses, linear_time_slice
+from fdwli3ds.util import extract_dimension, get_bounds, time_slice
 
 data_dir = os.path.join(
     os.path.dirname(__file__), 'data', 'echopulse')
@@ -142,3 +146,186 @@ def test_time_offset(reader_offset, reader):
         'time',
         'dimensional')
     assert float(times_offset[0] - times[0]) == 1300000
+
+
+def test_time_quals_trim_frame(reader):
+    quals = [
+        Qual('time', '>=', 41939.1),
+        Qual('time', '<=', 41939.2),
+    ]
+    allpatch = list(reader.execute(quals, ('points', 'time')))
+    assert 0 < len(allpatch) < 293679 / reader.patch_size
+    for patch in allpatch:
+        times = extract_dimension(
+            unhexlify(patch['points']),
+            reader.dimensions,
+            'time',
+            'dimensional')
+        assert times[0] == patch['time']
+        assert times.min() >= 41939.1
+        assert times.max() <= 41939.2
+
+
+def test_time_quals_skip_frame(reader):
+    quals = [Qual('time', '>', 41941)]
+    assert list(reader.execute(quals, ('points', 'time'))) == []
+
+
+def test_time_null_quals():
+    # time IS NULL and IS NOT NULL do not bound the scan
+    quals = [Qual('time', '=', None), Qual('time', '<>', None), Qual('time', '>', 10.5)]
+    assert get_bounds(quals) == ((10.5, False), None)
+
+
+@pytest.mark.parametrize('quals', [
+    [Qual('time', '>=', 10.3), Qual('time', '<', 10.7)],
+    [Qual('time', '>', 10.25), Qual('time', '<=', 10.75)],
+    [Qual('time', '=', 10.5)],
+    [Qual('time', '<', 9)],
+    [Qual('time', '>', 11)],
+])
+def test_linear_time_slice(quals):
+    t0, delta, count = 10.0, 0.05, 20
+    times = np.ones(count, dtype='float64') * t0 + \
+        np.arange(count, dtype='float64') * delta
+    bounds = get_bounds(quals)
+    assert linear_time_slice(t0, delta, count, bounds) == time_slice(times, bounds)
+
+
+def test_expand_pulses():
+    points = expand_pulses(
+        {'n_echo': np.array([2, 0, 1, 0], dtype='uint8'),
+         'phi': np.array([1, 2, 3, 4], dtype='float32')},
+        {'range': np.array([10, 11, 30], dtype='float32')})
+    assert points['n_echo'].tolist() == [2, 2, 0, 1, 0]
+    assert points['phi'].tolist() == [1, 1, 2, 3, 4]
+    assert points['range'].tolist() == [10, 11, 0, 30, 0]
+    assert points['echo'].tolist() == [0, 1, 0, 0, 0]
+    assert points['echo'].dtype == np.uint8
+
+
+@pytest.mark.parametrize('worker_type', ['process', 'thread'])
+def test_workers(reader, worker_type):
+    parallel = EchoPulse(
+        options={
+            'directory': data_dir,
+            'pcid': '1',
+            'workers': '2',
+            'worker_type': worker_type,
+        },
+        columns=None
+    )
+    assert list(parallel.execute(None, None)) == list(reader.execute(None, None))
+
+
+def test_index_file(tmpdir):
+    index = str(tmpdir.join('index.json'))
+    options = {'directory': data_dir, 'pcid': '1', 'index': index}
+    first = list(EchoPulse(options, None).execute(None, None))
+    assert os.path.exists(index)
+    # second read from the cached index
+    assert list(EchoPulse(options, None).execute(None, None)) == first
+
+
+def test_index_new_frames(tmpdir):
+    directory = str(tmpdir.join('echopulse'))
+    shutil.copytree(data_dir, directory)
+    reader = EchoPulse({'directory': directory, 'pcid': '1'}, None)
+    count = len(list(reader.execute(None, None)))
+    # a frame added to each dimension directory is seen by the same instance
+    for subdir in os.listdir(directory):
+        path = os.path.join(directory, subdir)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                shutil.copy(os.path.join(path, name),
+                            os.path.join(path, name.replace('41939', '41940')))
+    assert len(list(reader.execute(None, None))) == 2 * count
+
+
+def test_patch_id_quals(reader):
+    allpatch = list(reader.execute(None, ('points', 'patch_id')))
+    assert [patch['patch_id'] for patch in allpatch] == list(range(len(allpatch)))
+    quals = [Qual('patch_id', '>=', 3), Qual('patch_id', '<', 5)]
+    assert list(reader.execute(quals, ('points', 'patch_id'))) == allpatch[3:5]
+    quals = [Qual('patch_id', '=', len(allpatch) - 1)]
+    assert list(reader.execute(quals, ('points', 'patch_id'))) == allpatch[-1:]
+
+
+def test_time_quals_patch_alignment(reader):
+    allpatch = list(reader.execute(None, ('points', 'patch_id')))
+    quals = [Qual('time', '>=', 41939.1)]
+    first = next(reader.execute(quals, ('points', 'patch_id')))
+    full = unhexlify(allpatch[first['patch_id']]['points'])
+    trimmed = unhexlify(first['points'])
+    full_times = extract_dimension(full, reader.dimensions, 'time', 'dimensional')
+    times = extract_dimension(trimmed, reader.dimensions, 'time', 'dimensional')
+    # the first patch is the end of a full scan patch
+    assert 0 < len(times) <= len(full_times)
+    assert (full_times[-len(times):] == times).all()
+
+
+def test_projection(reader):
+    ept = EchoPulse(
+        options={
+            'directory': data_dir,
+            'pcid': '1',
+            'dimensions': 'amplitude, x, echo',
+        },
+        columns=None
+    )
+    # mapped and raw names are both accepted
+    assert [dim.name for dim in ept.dimensions] == ['amplitude', 'echo', 'x']
+    patch = unhexlify(next(ept.execute(None, None))['points'])
+    full_patch = unhexlify(next(reader.execute(None, None))['points'])
+    assert len(patch) == 13 + 3 * 5 + ept.patch_size * (4 + 1 + 4)
+    for name in ('amplitude', 'echo', 'x'):
+        assert (extract_dimension(patch, ept.dimensions, name, 'dimensional') ==
+                extract_dimension(full_patch, reader.dimensions, name,
+                                  'dimensional')).all()
+
+
+def test_compression(reader):
+    ept = EchoPulse(
+        options={
+            'directory': data_dir,
+            'pcid': '1',
+            'compression': 'auto',
+        },
+        columns=None
+    )
+    patch = unhexlify(next(ept.execute(None, None))['points'])
+    full_patch = unhexlify(next(reader.execute(None, None))['points'])
+    assert len(patch) < len(full_patch)
+    for dim in reader.dimensions:
+        assert (extract_dimension(patch, ept.dimensions, dim.name, 'dimensional') ==
+                extract_dimension(full_patch, reader.dimensions, dim.name,
+                                  'dimensional')).all()
+
+
+def test_bytea_output(reader):
+    ept = EchoPulse(
+        options={
+            'directory': data_dir,
+            'pcid': '1',
+            'output': 'bytea',
+        },
+        columns=None
+    )
+    for hexa, raw in zip(reader.execute(None, None), ept.execute(None, None)):
+        assert unhexlify(hexa['points']) == raw['points']
+
+
+@pytest.mark.parametrize('quals', [
+    [],
+    [Qual('time', '>=', 41939.1), Qual('time', '<=', 41939.2)],
+    [Qual('patch_id', '<', 100)],
+    [Qual('time', '>', 41941)],
+])
+def test_rel_size(reader, quals):
+    rows, width = reader.get_rel_size(quals, ('points', 'time'))
+    count = len(list(reader.execute(quals, ('points', 'time'))))
+    assert abs(rows - count) <= max(2, 0.05 * count)
+    # a full patch and the time
+    full = next(reader.execute([], ('points', )))
+    assert width == 8 + len(full['points'])
+    assert (('time', ), 1) in reader.get_path_keys()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from fdwli3ds.pcpatch import (
+    PC_DIM_NONE, PC_DIM_RLE, PC_DIM_SIGBITS, PC_DIM_ZLIB,
+    decode_dimension, encode_dimension)
+
+
+arrays = [
+    np.arange(400, dtype='uint8'),
+    np.zeros(300, dtype='int32'),
+    np.repeat(np.arange(10, dtype='uint16'), 100),
+    (1000 + np.random.RandomState(0).randint(0, 300, 401)).astype('uint16'),
+    np.random.RandomState(0).rand(333).astype('float32'),
+    41939 + np.arange(400) * 3.4e-6,
+    np.array([np.nan, np.nan, 1], dtype='float32'),
+]
+
+
+@pytest.mark.parametrize('compression', ['none', 'rle', 'sigbits', 'zlib', 'auto'])
+@pytest.mark.parametrize('values', arrays)
+def test_roundtrip(values, compression):
+    ctype, data = encode_dimension(values, compression)
+    decoded = decode_dimension(ctype, data, values.dtype, len(values))
+    assert decoded.tostring() == values.tostring()
+
+
+def test_rle_format():
+    ctype, data = encode_dimension(
+        np.array([5] * 300 + [7], dtype='uint16'), 'rle')
+    assert ctype == PC_DIM_RLE
+    assert data == b'\xff\x05\x00\x2d\x05\x00\x01\x07\x00'
+
+
+def test_sigbits_format():
+    ctype, data = encode_dimension(np.array([5, 6, 7], dtype='uint8'), 'sigbits')
+    assert ctype == PC_DIM_SIGBITS
+    # 2 unique bits, common value 4, then 01 10 11 packed from the high bit
+    assert data == b'\x02\x04\x6c'
+
+
+def test_sigbits_fallback():
+    # significant bits do not apply to 64 bits values
+    ctype, _ = encode_dimension(np.arange(10, dtype='float64'), 'sigbits')
+    assert ctype == PC_DIM_NONE
+
+
+def test_auto():
+    assert encode_dimension(arrays[3], 'auto')[0] == PC_DIM_SIGBITS
+    assert encode_dimension(
+        np.repeat(np.arange(4, dtype='float64'), 100), 'auto')[0] == PC_DIM_RLE
+    assert encode_dimension(
+        41939 + np.arange(400) * 3.4e-6, 'auto')[0] == PC_DIM_ZLIB
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import numpy as np
 import pytest
+from struct import pack
 from binascii import unhexlify
+from multicorn import Qual, SortKey
 
 from fdwli3ds import Rosbag
+from fdwli3ds.rosbag_ import (BagCatalog, PatchAssembler, compile_getter, compile_converter,
+                              compile_qual, filter_points, merge_scans,
+                              parse_pointcloud2, pointcloud_dtype)
+from fdwli3ds.util import read_ahead
 
 data_dir = os.path.join(
     os.path.dirname(__file__), 'data', 'rosbag')
@@ -74,3 +81,346 @@ def test_laser_patch_size(reader_laser_max_count):
     # patch header size: 13 bytes
     patch_size = 13 + reader_laser_max_count.patch_count_pointcloud * 32
     assert len(unhexlify(result['points'])) == patch_size
+
+
+def test_laser_fields():
+    rb = Rosbag(
+        options={
+            'rosbag': os.path.join(data_dir, bagfile),
+            'topic': '/Laser/velodyne_points',
+            'patch_count_pointcloud': '40',
+            'fields': 'x, y, z, intensity, ring',
+        },
+        columns=None
+    )
+    assert rb.patch_schema.count('<pc:dimension>') == 5
+    assert 'extra_byte' not in rb.patch_ply_header
+    result = next(rb.execute([], ('points', )))
+    # 4 floats and an uint16, without padding
+    assert len(unhexlify(result['points'])) == 13 + 40 * 18
+
+
+def test_rel_size(reader_laser):
+    rows, width = reader_laser.get_rel_size([], ('points', 'time'))
+    # a patch per message
+    assert rows == reader_laser.topics['/Laser/velodyne_points'].message_count
+    assert rows == len(list(reader_laser.execute([], ('points', 'time'))))
+    assert reader_laser.get_path_keys() == [(('time', ), 1)]
+    # first message without points
+    reader_laser.message_points = 0
+    assert reader_laser.get_rel_size([], ('points', 'time'))[0] == rows
+    reader_laser.patch_count_pointcloud = 40
+    assert reader_laser.get_rel_size([], ('points', 'time'))[0] == rows
+
+
+def test_time_quals(reader_laser):
+    columns = ('time', 'points')
+    times = [row['time'] for row in reader_laser.execute([], columns)]
+    assert [row['time'] for row in reader_laser.execute(
+        [Qual('time', '>=', times[1])], columns)] == times[1:]
+    # time is never null
+    assert list(reader_laser.execute([Qual('time', '=', None)], columns)) == []
+    assert [row['time'] for row in reader_laser.execute(
+        [Qual('time', '<>', None)], columns)] == times
+    # = ANY reads the messages between the first and last values
+    assert [row['time'] for row in reader_laser.execute(
+        [Qual('time', ('=', True), [times[2], times[1]])], columns)] == times[1:3]
+    assert list(reader_laser.execute([Qual('time', ('=', True), [])], columns)) == []
+
+
+def test_sort_reversed(reader_laser):
+    def sortkey(is_reversed):
+        return SortKey(attname='time', attnum=1, is_reversed=is_reversed,
+                       nulls_first=False, collate=None)
+    # a patch per message: both orders are supported
+    keys = [sortkey(False)], [sortkey(True)]
+    assert [reader_laser.can_sort(key) for key in keys] == list(keys)
+    rows = [row['time'] for row in reader_laser.execute([], ('time', ), [sortkey(False)])]
+    reversed_rows = [
+        row['time'] for row in reader_laser.execute([], ('time', ), [sortkey(True)])]
+    assert reversed_rows == rows[::-1]
+
+
+def test_prefetch(reader_laser_max_count):
+    rb = Rosbag(
+        options={
+            'rosbag': os.path.join(data_dir, bagfile),
+            'topic': '/Laser/velodyne_points',
+            'patch_count_pointcloud': '40',
+            'prefetch': '4',
+        },
+        columns=None
+    )
+    columns = ('time', 'points')
+    expected = [dict(row) for row in reader_laser_max_count.execute([], columns)]
+    assert [dict(row) for row in rb.execute([], columns)] == expected
+
+
+def test_scalar_quals():
+    # the table has a patch column, which is not requested
+    rb = Rosbag(
+        options={
+            'rosbag': os.path.join(data_dir, bagfile),
+            'topic': '/INS/SbgLogImuData',
+            'patch_columns': 'gyroscopes',
+        },
+        columns=None
+    )
+    assert 'points' in rb.columns
+    columns = ('time', 'timeStamp')
+    rows = list(rb.execute([], columns))
+    stamp = rows[10]['timeStamp']
+    quals = [Qual('timeStamp', '>', stamp)]
+    filtered = list(rb.execute(quals, columns))
+    assert rb.filters
+    assert filtered == [row for row in rows if row['timeStamp'] > stamp]
+    # rows of patches span several messages: quals are left to PostgreSQL
+    assert len(list(rb.execute(quals, ('time', 'points')))) == \
+        len(list(rb.execute([], ('time', 'points'))))
+    assert not rb.filters
+
+
+def test_catalog(tmpdir):
+    options = {
+        'rosbag': os.path.join(data_dir, bagfile),
+        'topic': '/Laser/velodyne_points',
+        'catalog': str(tmpdir.join('catalog.json')),
+    }
+    rb = Rosbag(dict(options), columns=None)
+    assert tmpdir.join('catalog.json').check()
+    BagCatalog.memory.clear()
+    cached = Rosbag(dict(options), columns=None)
+    # the bag is not opened until scanned
+    assert cached.catalogs[0].bag is None
+    assert cached.topics == rb.topics
+    assert cached.columns == rb.columns
+    assert cached.patch_schema == rb.patch_schema
+    assert next(cached.execute([], ('points', ))) == next(rb.execute([], ('points', )))
+
+
+def test_catalog_modified_bag(tmpdir):
+    path = str(tmpdir.join('test.bag'))
+    opened = []
+
+    class Bag(object):
+        def __init__(self, filename, mode):
+            self.count = os.path.getsize(filename)
+            opened.append(self)
+
+        def get_type_and_topic_info(self):
+            infos = Msg(msg_type='sensor_msgs/Imu', message_count=self.count)
+            return Msg(topics={'/imu': infos})
+
+        def get_start_time(self):
+            return 10.
+
+        def get_end_time(self):
+            return 10. + self.count
+
+        def close(self):
+            pass
+
+    tmpdir.join('test.bag').write('x')
+    catalog = BagCatalog(path, Bag, str(tmpdir.join('catalog.json')))
+    assert catalog.topics()['/imu'].message_count == 1
+    catalog.get_bag()
+    # the bag grows while the catalog is in use
+    tmpdir.join('test.bag').write('xx')
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    assert catalog.topics()['/imu'].message_count == 2
+    assert catalog.time_range()[1] == 12 * 1000000000 + 1000
+    assert catalog.get_bag().count == 2
+    # an unchanged bag is not opened again
+    assert catalog.topics()['/imu'].message_count == 2
+    assert len(opened) == 2
+
+
+def test_session_open_bags(tmpdir, monkeypatch):
+    class Sample(object):
+        __slots__ = ['seq', 'value']
+        _slot_types = ['uint32', 'float64']
+
+    handles = []
+
+    class Bag(object):
+        def __init__(self, filename, mode):
+            # at most one bag of the session is open at a time
+            assert all(handle.closed for handle in handles)
+            self.closed = False
+            handles.append(self)
+
+        def get_type_and_topic_info(self):
+            infos = Msg(msg_type='test/Sample', message_count=10)
+            return Msg(topics={'/sample': infos})
+
+        def get_start_time(self):
+            return 10.
+
+        def get_end_time(self):
+            return 11.
+
+        def read_messages(self, topics):
+            msg = Sample()
+            msg.seq, msg.value = 0, 1.
+            yield topics, msg, None
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr('fdwli3ds.rosbag_.import_bag', lambda options: Bag)
+    for name in ('a', 'b', 'c'):
+        tmpdir.join(name + '.bag').write(name)
+    rb = Rosbag({'rosbag': str(tmpdir.join('*.bag')), 'topic': '/sample'}, None)
+    assert rb.topics['/sample'].message_count == 30
+    # the first bag is opened again to read the columns of the topic
+    assert len(handles) == 4
+    assert all(handle.closed for handle in handles)
+
+
+@pytest.mark.parametrize('size, step', [(40, 40), (40, 32)])
+def test_patch_assembler(size, step):
+    data = bytearray(range(256)) * 2
+    assembler = PatchAssembler()
+    patches = []
+    for start in range(0, len(data), 50):
+        assembler.append(bytes(data[start:start + 50]))
+        patches.extend(patch.tostring() for patch in assembler.patches(size, step))
+    expected = [
+        bytes(data[start:start + size])
+        for start in range(0, len(data) - size + 1, step)
+    ]
+    assert patches == expected
+    assert assembler.view().tostring() == bytes(data[len(expected) * step:])
+
+
+class Msg(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Stamp(object):
+    def __init__(self, nsec):
+        self.nsec = nsec
+
+    def to_nsec(self):
+        return self.nsec
+
+
+def test_compiled_plan():
+    msg = Msg(
+        header=Msg(seq=3, stamp=Stamp(42)),
+        angular_velocity=Msg(x=1., y=2., z=3.),
+        orientation=Msg(x=1., y=2., z=3., w=4.),
+        data='\x01\x00\x02\x00',
+        points=[Msg(x=1), Msg(x=2)],
+    )
+    expected = {
+        'header.seq': (None, 3),
+        'header.stamp': (None, 42),
+        'angular_velocity': (None, (1., 2., 3.)),
+        'orientation': (None, (1., 2., 3., 4.)),
+        'data': ('<2H', (1, 2)),
+        'points.x': (None, (1, 2)),
+    }
+    for column, (fmt, value) in expected.items():
+        getter, attr = compile_getter(msg, column)
+        convert = compile_converter(attr, fmt)
+        assert (convert(getter(msg)) if convert else getter(msg)) == value
+
+
+def test_parse_pointcloud2():
+    data = b''.join(pack('<fH', i, i) for i in range(3))
+    raw = (pack('<4I', 7, 1492648601, 948956966, 8) + b'velodyne' +
+           pack('<3I', 1, 3, 2) +
+           pack('<I', 1) + b'x' + pack('<IBI', 0, 7, 1) +
+           pack('<I', 4) + b'ring' + pack('<IBI', 4, 4, 1) +
+           pack('<B3I', 0, 6, 18, len(data)) + data + pack('<B', 1))
+    msg = parse_pointcloud2(raw)
+    assert msg.header == (7, 1492648601948956966, b'velodyne')
+    assert (msg.height, msg.width, msg.point_step, msg.row_step) == (1, 3, 6, 18)
+    assert [tuple(field) for field in msg.fields] == [(b'x', 0, 7, 1), (b'ring', 4, 4, 1)]
+    assert msg.is_bigendian is False and msg.is_dense is True
+    assert msg.data.tobytes() == data
+
+
+def test_merge_scans():
+    started = []
+
+    def scan(name, times):
+        started.append(name)
+        for t in times:
+            yield t, name
+
+    scans = [(0, scan('a', [0, 2, 4])), (3, scan('b', [3, 4, 6])), (7, scan('c', [7, 8]))]
+    merged = merge_scans(scans)
+    assert [next(merged) for _ in range(2)] == [(0, 'a'), (2, 'a')]
+    # scans are only started when the merge reaches their start time
+    assert started == ['a']
+    assert list(merged) == [(3, 'b'), (4, 'a'), (4, 'b'), (6, 'b'), (7, 'c'), (8, 'c')]
+
+
+@pytest.mark.parametrize('qual, accepted', [
+    (Qual('header.seq', '>', 2), [3, 4]),
+    (Qual('header.seq', '<>', 2), [0, 1, 3, 4]),
+    (Qual('header.seq', ('=', True), [1, 3, 7]), [1, 3]),
+    (Qual('header.seq', ('<', True), [1, 3]), [0, 1, 2]),
+    (Qual('header.seq', ('<>', False), [1, 3]), [0, 2, 4]),
+])
+def test_compile_qual(qual, accepted):
+    check = compile_qual(qual)
+    assert [value for value in range(5) if check(value)] == accepted
+
+
+def test_compile_qual_unsupported():
+    assert compile_qual(Qual('header.frame_id', '~~', 'velo%')) is None
+    assert compile_qual(Qual('header.seq', '=', None)) is None
+
+
+def test_pointcloud_dtype():
+    msg = Msg(
+        fields=[Msg(name='x', offset=0, datatype=7, count=1),
+                Msg(name='ring', offset=6, datatype=4, count=1)],
+        point_step=12, is_bigendian=False)
+    view, packed = pointcloud_dtype(msg, ['x', 'ring', 'extra_byte_4'])
+    assert view.itemsize == 12
+    assert [view.fields[name][1] for name in view.names] == [0, 4, 6]
+    assert packed.itemsize == 7
+    data = np.arange(24, dtype='u1').tostring()
+    points = np.frombuffer(data, dtype=view)
+    assert points['ring'].tolist() == [0x0706, 0x1312]
+
+
+def test_filter_points():
+    points = np.zeros(6, dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    points['x'] = [1, np.nan, 5, 1.05, 20, 5.5]
+    points['y'] = [0, 0, 0, 0, 0, 0]
+    assert filter_points(points).tolist() == [0, 1, 2, 3, 4, 5]
+    assert filter_points(points, drop_nan=True).tolist() == [0, 2, 3, 4, 5]
+    assert filter_points(points, range_min=2, range_max=10).tolist() == [2, 5]
+    # first point of each voxel, in order
+    assert filter_points(points, voxel_size=1).tolist() == [0, 2, 4]
+    assert filter_points(points, voxel_size=1, range_min=2).tolist() == [2, 4]
+    assert filter_points(points[:0], voxel_size=1).tolist() == []
+
+
+def test_read_ahead():
+    closed = []
+
+    def items(count, error=None):
+        try:
+            for item in range(count):
+                yield item
+            if error:
+                raise error
+        finally:
+            closed.append(count)
+
+    assert list(read_ahead(items(100), 3)) == list(range(100))
+    with pytest.raises(ValueError):
+        list(read_ahead(items(10, ValueError('bad message')), 3))
+    # stopped early, the items are closed by the thread
+    ahead = read_ahead(items(1000), 3)
+    assert [next(ahead) for _ in range(5)] == list(range(5))
+    ahead.close()
+    assert closed == [100, 10, 1000]
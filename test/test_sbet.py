@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import json
+import shutil
 from binascii import unhexlify
 
+import numpy as np
 import pytest
+from multicorn import Qual
 
 from fdwli3ds import Sbet
+from fdwli3ds.sbet import SbetCatalog, interpolate_poses, simplify_trajectory
 from fdwli3ds.util import extract_dimension
 
 sbet_file = os.path.join(
@@ -152,3 +157,294 @@ def test_overlap_patch(reader_overlap):
     first_array = extract_dimension(first_patch, reader_overlap.dimensions, 'm_time')
     second_array = extract_dimension(second_patch, reader_overlap.dimensions, 'm_time')
     assert first_array[-1] == second_array[0]
+
+
+def test_compression(reader):
+    reader.overlap = False
+    compressed = Sbet(
+        options={
+            'sources': sbet_file,
+            'pcid': '1',
+            'overlap': 'false',
+            'compression': 'auto'
+        },
+        columns=None
+    )
+    patch = unhexlify(next(reader.execute(None, None))['points'])
+    compressed_patch = unhexlify(next(compressed.execute(None, None))['points'])
+    for dim in reader.dimensions:
+        assert (extract_dimension(patch, reader.dimensions, dim.name) ==
+                extract_dimension(compressed_patch, compressed.dimensions,
+                                  dim.name, 'dimensional')).all()
+
+
+@pytest.mark.parametrize('overlap', ['true', 'false'])
+def test_bytea_output(overlap):
+    options = {'sources': sbet_file, 'pcid': '1', 'overlap': overlap}
+    hexa = Sbet(options=options, columns=None)
+    raw = Sbet(options=dict(options, output='bytea'), columns=None)
+    for hexa_row, raw_row in zip(hexa.execute(None, None), raw.execute(None, None)):
+        assert unhexlify(hexa_row['points']) == raw_row['points']
+
+
+@pytest.mark.parametrize('overlap', ['true', 'false'])
+def test_time_quals(overlap):
+    options = {'sources': sbet_file, 'pcid': '1', 'overlap': overlap}
+    full = list(Sbet(options=options, columns=None).execute(None, ('points', 'time')))
+    reader = Sbet(options=options, columns=None)
+    quals = [Qual('time', '>=', 300010.0025), Qual('time', '<', 300020)]
+    patches = list(reader.execute(quals, ('points', 'time')))
+    assert 0 < len(patches) < len(full)
+    times = [
+        extract_dimension(unhexlify(patch['points']), reader.dimensions, 'm_time')
+        for patch in patches
+    ]
+    for patch, patch_times in zip(patches, times):
+        assert 300010.0025 <= patch['time'] < 300020
+        assert patch_times[-1] < 300020
+    # patches are aligned on the full scan, the first one is truncated
+    first = [row for row in full if row['time'] <= patches[0]['time']][-1]
+    first_times = extract_dimension(
+        unhexlify(first['points']), reader.dimensions, 'm_time')
+    assert (first_times[-len(times[0]):] == times[0]).all()
+    assert [row['points'] for row in patches[1:]] == \
+        [row['points'] for row in full if row['time'] > patches[0]['time']
+         ][:len(patches) - 1]
+    if overlap == 'true':
+        # the previous record is still repeated in the first patch
+        assert times[0][0] < 300010.0025 <= times[0][1]
+
+
+def test_time_quals_offset(reader_offset):
+    quals = [Qual('time', '=', 1600010)]
+    patches = list(reader_offset.execute(quals, ('points', 'time')))
+    assert [patch['time'] for patch in patches] == [1600010]
+    assert list(reader_offset.execute([Qual('time', '<', 1300000)], None)) == []
+
+
+@pytest.mark.parametrize('overlap', ['true', 'false'])
+def test_chunks(monkeypatch, overlap):
+    options = {'sources': sbet_file, 'pcid': '1', 'overlap': overlap}
+    full = list(Sbet(options=options, columns=None).execute(None, ('points', 'time')))
+    # chunks of 3 patches
+    monkeypatch.setattr('fdwli3ds.sbet.CHUNK_SIZE', 300)
+    reader = Sbet(options=options, columns=None)
+    assert list(reader.execute(None, ('points', 'time'))) == full
+    quals = [Qual('time', '>', 300010.0025), Qual('time', '<=', 300011.5)]
+    assert [row['points'] for row in reader.execute(quals, None)][1:-1] == \
+        [row['points'] for row in full if 300010.0025 < row['time'] <= 300011.5][:-1]
+
+
+def test_catalog(tmpdir, monkeypatch):
+    catalog = str(tmpdir.join('catalog.json'))
+    options = {'sources': sbet_file, 'pcid': '1', 'catalog': catalog}
+    entry, = Sbet(options=options, columns=None).catalog.load([sbet_file])
+    assert entry['records'] == 50000
+    assert (entry['tmin'], entry['tmax']) == (300000, 300249.995)
+    assert os.path.exists(catalog)
+
+    # cached entries are reused
+    def index_file(*args):
+        raise AssertionError('file indexed again')
+    monkeypatch.setattr(SbetCatalog, 'index_file', index_file)
+    reader = Sbet(options=options, columns=None)
+    assert reader.catalog.load(reader.sources) == [entry]
+
+
+def test_catalog_shared(tmpdir):
+    catalog = str(tmpdir.join('catalog.json'))
+    other = str(tmpdir.join('other.bin'))
+    removed = str(tmpdir.join('removed.bin'))
+    shutil.copy(sbet_file, other)
+    shutil.copy(sbet_file, removed)
+    for sources in (sbet_file, other, removed):
+        reader = Sbet({'sources': sources, 'pcid': '1', 'catalog': catalog}, None)
+        reader.catalog.load(reader.sources)
+    os.remove(removed)
+    reader = Sbet({'sources': sbet_file, 'pcid': '1', 'catalog': catalog}, None)
+    reader.catalog.load(reader.sources)
+    # entries of other tables are kept, unless their file was removed
+    with open(catalog) as f:
+        assert sorted(json.load(f)['files']) == sorted([sbet_file, other])
+
+
+def test_catalog_modified_file(tmpdir):
+    catalog = str(tmpdir.join('catalog.json'))
+    source = str(tmpdir.join('sbet.bin'))
+    records = np.fromfile(sbet_file, dtype='<f8').reshape(-1, 17)
+    records[:40000].tofile(source)
+    options = {'sources': source, 'pcid': '1', 'catalog': catalog}
+    reader = Sbet(options, None)
+    quals = [Qual('time', '>', 300200)]
+    assert list(reader.execute(quals, None)) == []
+    # the file grows between two scans of the same table
+    with open(source, 'ab') as f:
+        records[40000:].tofile(f)
+    mtime = os.path.getmtime(source) + 10
+    os.utime(source, (mtime, mtime))
+    rows = len(list(reader.execute(quals, None)))
+    assert rows > 0
+    assert rows == len(list(Sbet(options, None).execute(quals, None)))
+
+
+@pytest.mark.parametrize('bbox, count', [
+    ('2, 48, 3, 49', 500),
+    ('2.301, 48.801, 2.302, 48.802', 500),
+    ('3, 48, 4, 49', 0),
+])
+def test_bbox(bbox, count):
+    reader = Sbet(
+        options={'sources': sbet_file, 'pcid': '1', 'bbox': bbox},
+        columns=None
+    )
+    assert len(list(reader.execute(None, None))) == count
+
+
+def test_time_quals_skip_source(reader):
+    def read_sbet(*args):
+        raise AssertionError('source read')
+    reader.read_sbet = read_sbet
+    assert list(reader.execute([Qual('time', '>', 300250)], None)) == []
+
+
+@pytest.fixture
+def reader_poses(scope='module'):
+    return Sbet(
+        options={
+            'sources': sbet_file,
+            'poses': 'true',
+            'time_offset': '1300000'
+        },
+        columns=None
+    )
+
+
+def test_poses_range(reader_poses):
+    quals = [Qual('time', '>=', 1600010), Qual('time', '<', 1600010.02)]
+    poses = list(reader_poses.execute(quals, ('time', 'x', 'm_time')))
+    assert [pose['time'] for pose in poses] == pytest.approx(
+        [1600010, 1600010.005, 1600010.01, 1600010.015])
+    assert all(pose['m_time'] == pose['time'] for pose in poses)
+    assert all(2.3 <= pose['x'] <= 2.305 for pose in poses)
+
+
+def test_poses_interpolation(reader_poses):
+    records = list(reader_poses.execute(
+        [Qual('time', '>=', 1600010), Qual('time', '<=', 1600010.005)], None))
+    times = [1600010.0025, 1600010, 1700000, records[1]['time']]
+    poses = list(reader_poses.execute(
+        [Qual('time', ('=', True), times)], None))
+    # times outside the trajectory are ignored, poses are ordered by time
+    assert [pose['time'] for pose in poses] == sorted(times[:2] + times[3:])
+    assert poses[0] == records[0]
+    assert poses[2] == records[1]
+    for name in ('x', 'y', 'z', 'm_xVelocity'):
+        assert poses[1][name] == pytest.approx(
+            (records[0][name] + records[1][name]) / 2)
+
+
+def test_interpolate_angles():
+    sbet = np.zeros(3, dtype=[('m_time', 'f8'), ('m_plateformHeading', 'f8')])
+    sbet['m_time'] = [0, 1, 2]
+    sbet['m_plateformHeading'] = [3.0, -3.0, 3.1]
+    poses = interpolate_poses(
+        sbet, np.array([0.5, 1, 1.5, 2]), ['m_plateformHeading'])
+    # the shortest arc goes through pi
+    assert poses['m_plateformHeading'] == pytest.approx(
+        [np.pi, -3.0, -3.0 - (2 * np.pi - 6.1) / 2, 3.1])
+    # headings in [0, 2 pi) keep their range
+    sbet['m_plateformHeading'] = [3.5, 6.2, 0.1]
+    poses = interpolate_poses(
+        sbet, np.array([0, 0.5, 1, 1.5, 2]), ['m_plateformHeading'])
+    assert poses['m_plateformHeading'] == pytest.approx(
+        [3.5, 4.85, 6.2, 6.2 + (0.1 + 2 * np.pi - 6.2) / 2, 0.1])
+
+
+@pytest.mark.parametrize('decimate', ['200', '1s'])
+def test_decimate(decimate):
+    reader = Sbet(
+        options={'sources': sbet_file, 'pcid': '1', 'overlap': 'false',
+                 'decimate': decimate},
+        columns=None
+    )
+    times = np.concatenate([
+        extract_dimension(unhexlify(patch['points']), reader.dimensions, 'm_time')
+        for patch in reader.execute(None, None)
+    ])
+    assert (times == 300000 + np.arange(250)).all()
+    # patches are aligned on the decimated full scan
+    quals = [Qual('time', '>=', 300120.5)]
+    patch = next(reader.execute(quals, None))
+    assert extract_dimension(
+        unhexlify(patch['points']), reader.dimensions, 'm_time')[0] == 300121
+
+
+def test_simplify_trajectory():
+    m_time = np.arange(201, dtype='float64')
+    # a straight line with a corner
+    x = np.radians(np.r_[np.linspace(2, 2.001, 101), np.full(100, 2.001)])
+    y = np.radians(np.r_[np.full(100, 48), np.linspace(48, 48.001, 101)])
+    z = np.zeros(201)
+    keep = simplify_trajectory(m_time, x, y, z, 0.5)
+    assert np.flatnonzero(keep).tolist() == [0, 100, 200]
+    keep = simplify_trajectory(m_time, x + 1e-8 * np.sin(m_time), y, z, 0.01)
+    assert 3 < keep.sum() < 201
+
+
+def test_simplify():
+    reader = Sbet(
+        options={'sources': sbet_file, 'pcid': '1', 'overlap': 'false',
+                 'decimate': '10', 'simplify': '0.1'},
+        columns=None
+    )
+    times = np.concatenate([
+        extract_dimension(unhexlify(patch['points']), reader.dimensions, 'm_time')
+        for patch in reader.execute(None, None)
+    ])
+    assert times[0] == 300000 and times[-1] == 300249.95
+    assert len(times) < 5000
+
+
+@pytest.mark.parametrize('srid, first, last', [
+    # reference values computed with PROJ
+    (2154, (648583.262, 6855774.716), (648955.401, 6856327.387)),
+    (32631, (448595.715, 5405459.390), (448967.952, 5406011.817)),
+    (3949, (1648579.781, 8177997.363), (1648952.141, 8178549.939)),
+])
+def test_target_srid(srid, first, last):
+    options = {'sources': sbet_file, 'target_srid': str(srid)}
+    reader = Sbet(options=dict(options, pcid='1', overlap='false'), columns=None)
+    scales = {dim.name: float(dim.scale) for dim in reader.dimensions}
+    assert scales['x'] == scales['y'] == 0.01
+    patches = [unhexlify(patch['points']) for patch in reader.execute(None, None)]
+    x = extract_dimension(patches[0], reader.dimensions, 'x')[0] * scales['x']
+    y = extract_dimension(patches[0], reader.dimensions, 'y')[0] * scales['y']
+    assert (x, y) == pytest.approx(first, abs=0.01)
+    x = extract_dimension(patches[-1], reader.dimensions, 'x')[-1] * scales['x']
+    y = extract_dimension(patches[-1], reader.dimensions, 'y')[-1] * scales['y']
+    assert (x, y) == pytest.approx(last, abs=0.01)
+
+    poses = Sbet(options=dict(options, poses='true'), columns=None)
+    pose = next(poses.execute([Qual('time', '=', 300000)], ('time', 'x')))
+    assert (pose['x'], ) == pytest.approx(first[:1], abs=0.001)
+
+
+@pytest.mark.parametrize('quals', [
+    [],
+    [Qual('time', '<', 300125)],
+    [Qual('time', '>=', 300010), Qual('time', '<', 300020)],
+    [Qual('time', '>', 300300)],
+])
+def test_rel_size(reader, quals):
+    rows, width = reader.get_rel_size(quals, ('points', 'time'))
+    assert abs(rows - len(list(reader.execute(quals, ('points', 'time'))))) <= 1
+    # patches of 101 points (overlap), hex encoded
+    assert width == 8 + 2 * (13 + 101 * np.dtype(reader.patch_type()).itemsize)
+    assert reader.get_path_keys() == [(('time', ), 1)]
+
+
+def test_rel_size_poses(reader_poses):
+    quals = [Qual('time', ('=', True), [1600000.0025, 1600001, 1600002])]
+    assert reader_poses.get_rel_size(quals, ('time', 'x', 'y'))[0] == 3
+    quals = [Qual('time', '<', 1600125)]
+    assert reader_poses.get_rel_size(quals, ('time', 'x', 'y')) == (25000, 24)